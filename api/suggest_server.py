@@ -1,8 +1,20 @@
 import os
 import json
+import hashlib
+import heapq
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse
 
+try:
+    import numpy as np
+except ImportError:  # optional: scoring runs in pure Python without it
+    np = None
+
 import google.generativeai as genai
 
 API_KEY = os.getenv('GOOGLE_API_KEY') or os.getenv('GEMINI_API_KEY')
@@ -10,99 +22,430 @@ if API_KEY:
     genai.configure(api_key=API_KEY)
 
 MODEL_NAME = os.getenv('REWEAVE_GEMINI_MODEL', 'gemini-1.5-flash')
+_MODEL = None
+_MODEL_LOCK = threading.Lock()
+CACHE_SIZE = int(os.getenv('REWEAVE_SUGGEST_CACHE_SIZE', '1024'))
+CACHE_TTL = float(os.getenv('REWEAVE_SUGGEST_CACHE_TTL', '900'))
+# A JSON file ({"products": [...]} or a bare list) or the backend's reweave.db
+CATALOG_SOURCE = os.getenv('REWEAVE_SUGGEST_CATALOG') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'products.json')
+CATALOG_CHECK_INTERVAL = float(os.getenv('REWEAVE_SUGGEST_CATALOG_CHECK', '2'))
+CATALOG_HISTORY = 4
+# The model sees the top REWEAVE_SUGGEST_CANDIDATES products by the
+# deterministic scorer, packed into a prompt of at most
+# REWEAVE_SUGGEST_PROMPT_TOKENS (estimated)
+PROMPT_CANDIDATES = int(os.getenv('REWEAVE_SUGGEST_CANDIDATES', '40'))
+PROMPT_TOKEN_LIMIT = int(os.getenv('REWEAVE_SUGGEST_PROMPT_TOKENS', '2000'))
 
-def build_product_summary(products):
-    lines = []
-    for p in products[:50]:
-        colors = []
+# Bounded LRU with a per-entry TTL, shared by the handler threads
+class SuggestionCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+_CACHE = SuggestionCache(CACHE_SIZE, CACHE_TTL)
+
+def palette_weights(entries):
+    # Palette colours as {colour: weight}. Entries are names (weight 1) or
+    # {"color", "weight"} objects, and repeats add up; a string is a list of
+    # names separated by commas, slashes or "and".
+    if isinstance(entries, str):
+        entries = re.split(r'\s*(?:[,/;|&]|\band\b)\s*', entries)
+    weights = {}
+    for entry in (entries or []):
+        weight = 1.0
+        if isinstance(entry, dict):
+            try:
+                weight = float(entry.get('weight', 1))
+            except (TypeError, ValueError):
+                weight = 1.0
+            entry = entry.get('color') or entry.get('name') or ''
+        color = str(entry).strip().lower()
+        if color:
+            weights[color] = weights.get(color, 0.0) + weight
+    return weights
+
+def normalize_prefs(mode, payload):
+    # Only the fields each mode reads, in a canonical form, so equivalent
+    # requests share a cache entry
+    if mode == 'mirror':
+        return {'colors': palette_weights(payload.get('colors'))}
+    try:
+        budget = float(payload.get('budget')) if payload.get('budget') not in (None, '') else None
+    except (TypeError, ValueError):
+        budget = None
+    return {
+        'occasion': str(payload.get('occasion') or '').strip().lower(),
+        'palette': palette_weights(payload.get('palette')),
+        'budget': budget,
+    }
+
+def catalog_version(products):
+    return hashlib.sha1(json.dumps(products, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:16]
+
+# --- Product features ---
+# Occasions the copilot filters on, by the categories that qualify
+OCCASION_CATEGORIES = {
+    'work': {'tote', 'sling'},
+    'casual': {'pouch', 'sling'},
+    'evening': {'sling'},
+}
+
+def product_min_price(p):
+    prices = []
+    for price in [p.get('price')] + [v.get('price') for v in (p.get('variants') or [])]:
+        try:
+            if price is not None and float(price) > 0:
+                prices.append(float(price))
+        except (TypeError, ValueError):
+            pass
+    return min(prices) if prices else 0.0
+
+# What the scorers read from a product, derived once per catalog version
+class ProductFeatures:
+    __slots__ = ('product', 'id', 'colors', 'categories', 'min_price', 'occasions', 'summary', 'summary_tokens')
+
+    def __init__(self, p):
+        self.product = p
+        self.id = p.get('id')
+        colors = set()
         for v in (p.get('variants') or []):
             opt = v.get('options') or {}
             c = opt.get('Color') or opt.get('color')
             if c:
-                colors.append(str(c))
-        lines.append(f"- id:{p.get('id')} name:{p.get('name')} price:RM {p.get('price')} categories:{(p.get('categories') or [])} colors:{colors}")
+                colors.add(str(c).lower())
+        self.colors = frozenset(colors)
+        self.categories = frozenset(str(c).lower() for c in (p.get('categories') or []))
+        self.min_price = product_min_price(p)
+        self.occasions = frozenset(occ for occ, cats in OCCASION_CATEGORIES.items() if cats & self.categories)
+        # Prompt catalog line, rendered once per catalog version
+        self.summary = product_summary_line(p)
+        self.summary_tokens = estimate_tokens(self.summary) + 1
+
+# --- Vectorized scoring ---
+# With NumPy, a catalog is also held as arrays: a product x colour 0/1
+# matrix, a bag mask, min prices and one mask per occasion. A mirror request
+# is one matrix-vector product with the palette weights; copilot is a mask
+# over occasion and budget. Top-k uses argpartition, then orders the k by
+# (key, catalog position) so results match the pure-Python scorer exactly.
+# Without NumPy the feature index is scored in Python.
+class ScoringIndex:
+    def __init__(self, features):
+        self.color_index = {c: i for i, c in enumerate(sorted({c for f in features for c in f.colors}))}
+        self.ids = [f.id for f in features]
+        self.min_price = np.array([f.min_price for f in features], dtype=np.float64)
+        self.matrix = np.zeros((len(features), len(self.color_index)), dtype=np.float32)
+        for i, f in enumerate(features):
+            for c in f.colors:
+                self.matrix[i, self.color_index[c]] = 1
+        self.bags = np.array([1 if 'bags' in f.categories else 0 for f in features], dtype=np.float32)
+        self.occasions = {occ: np.array([occ in f.occasions for f in features], dtype=bool)
+                          for occ in OCCASION_CATEGORIES}
+
+    def palette_scores(self, weights):
+        w = np.zeros(len(self.color_index), dtype=np.float32)
+        for color, weight in weights.items():
+            i = self.color_index.get(color)
+            if i is not None:
+                w[i] = weight
+        return self.matrix @ w
+
+    def mirror(self, weights, k):
+        scores = 2 * self.palette_scores(weights) + self.bags
+        return top_k(-scores, np.arange(len(self.ids)), k)
+
+    def copilot(self, occasion, budget, weights, k):
+        # Eligible by occasion and budget; best palette match, then cheapest
+        mask = self.min_price <= budget
+        if occasion in self.occasions:
+            mask &= self.occasions[occasion]
+        candidates = np.flatnonzero(mask)
+        if not weights:
+            return top_k(self.min_price, candidates, k)
+        return top_k(-self.palette_scores(weights), candidates, k, self.min_price)
+
+def top_k(keys, candidates, k, tiebreak=None):
+    # The k candidates with the smallest keys, ties by `tiebreak` when given
+    # and then by position, in that order
+    if len(candidates) > k:
+        values = keys[candidates]
+        kth = values[np.argpartition(values, k - 1)[k - 1]]
+        below = candidates[values < kth]
+        tied = candidates[values == kth]
+        need = k - len(below)
+        candidates = np.concatenate([below, tied[:need] if tiebreak is None else top_k(tiebreak, tied, need)])
+    if tiebreak is None:
+        return candidates[np.lexsort((candidates, keys[candidates]))]
+    return candidates[np.lexsort((candidates, tiebreak[candidates], keys[candidates]))]
+
+def palette_weight(weights, f):
+    matched = weights.keys() & f.colors
+    return sum(weights[c] for c in matched) if matched else 0
+
+# --- Catalog registry ---
+# The service holds the catalog itself, so requests carry only preferences
+# and optionally the catalog version they were built against. A version is
+# the digest of the product list: identical on every instance and restart.
+# The source is re-read when its mtime/size changes (checked at most every
+# REWEAVE_SUGGEST_CATALOG_CHECK seconds, on request); the last few versions
+# stay resolvable so a client on the previous one isn't rejected mid-reload.
+class Catalog:
+    def __init__(self, products, version=None):
+        self.products = products
+        self.version = version or catalog_version(products)
+        self.features = [ProductFeatures(p) for p in products]
+        self._scoring = None
+        self._lock = threading.Lock()
+
+    def scoring(self):
+        # ScoringIndex built on first use; None without NumPy
+        if np is None:
+            return None
+        if self._scoring is None:
+            with self._lock:
+                if self._scoring is None:
+                    self._scoring = ScoringIndex(self.features)
+        return self._scoring
+
+def load_catalog_db(path):
+    # Backend products with live variant price/stock, in the shape the
+    # storefront JSON uses (name, categories, variants[].options)
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        products = {}
+        variants = {}
+        for pid, data_json in conn.execute("SELECT id, data_json FROM products ORDER BY rowid"):
+            p = json.loads(data_json or '{}')
+            p['id'] = pid
+            p.setdefault('name', p.get('title'))
+            if not p.get('categories') and p.get('category'):
+                p['categories'] = [p['category']]
+            p['variants'] = list(p.get('variants') or [])
+            for v in p['variants']:
+                variants[v.get('sku')] = v
+            products[pid] = p
+        for sku, pid, price, stock, options_json in conn.execute(
+                "SELECT sku, product_id, price, stock, options_json FROM variants ORDER BY rowid"):
+            if pid not in products:
+                continue
+            v = variants.get(sku)
+            if v is None:
+                v = variants[sku] = {'sku': sku}
+                products[pid]['variants'].append(v)
+            v['price'] = price
+            v['stock'] = stock
+            options = json.loads(options_json or '{}')
+            if options:
+                v['options'] = options
+    finally:
+        conn.close()
+    return list(products.values())
+
+def load_catalog_file(path):
+    if path.endswith('.db'):
+        return load_catalog_db(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return (data.get('products') or []) if isinstance(data, dict) else data
+
+class CatalogRegistry:
+    def __init__(self, source, check_interval, history):
+        self.source = source
+        self.check_interval = check_interval
+        self.history = history
+        self._lock = threading.Lock()
+        self._versions = OrderedDict()
+        self._current = None
+        self._signature = None
+        self._checked = None
+
+    def _stat(self):
+        sig = []
+        for path in (self.source, self.source + '-wal'):
+            try:
+                st = os.stat(path)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    def reload(self):
+        with self._lock:
+            self._checked = time.monotonic()
+            sig = self._stat()
+            if sig == self._signature:
+                return self._current
+            try:
+                catalog = Catalog(load_catalog_file(self.source))
+                catalog.scoring()
+            except (OSError, ValueError, sqlite3.Error) as e:
+                # Keep serving the last good version
+                print(f'[catalog] loading {self.source} failed: {e}')
+                return self._current
+            self._signature = sig
+            if self._current is None or catalog.version != self._current.version:
+                self._versions[catalog.version] = catalog
+                self._versions.move_to_end(catalog.version)
+                while len(self._versions) > self.history:
+                    self._versions.popitem(last=False)
+                self._current = catalog
+                print(f'[catalog] version {catalog.version}: {len(catalog.products)} products from {self.source}')
+            return self._current
+
+    def current(self):
+        checked = self._checked
+        if checked is None or time.monotonic() - checked >= self.check_interval:
+            return self.reload()
+        return self._current
+
+    def get(self, version=None):
+        # None when the requested version is unknown (or nothing is loaded)
+        current = self.current()
+        if not version or (current is not None and version == current.version):
+            return current
+        with self._lock:
+            return self._versions.get(version)
+
+    def versions(self):
+        with self._lock:
+            return list(self._versions)
+
+CATALOG = CatalogRegistry(CATALOG_SOURCE, CATALOG_CHECK_INTERVAL, CATALOG_HISTORY)
+
+def cache_key(mode, prefs, version):
+    raw = json.dumps([mode, prefs, version], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def estimate_tokens(text):
+    # ~4 characters per token for English and JSON-ish text; only used to
+    # budget, so a rough count is enough
+    return (len(text) + 3) // 4
+
+def product_summary_line(p):
+    colors = []
+    for v in (p.get('variants') or []):
+        opt = v.get('options') or {}
+        c = opt.get('Color') or opt.get('color')
+        if c:
+            colors.append(str(c))
+    return f"- id:{p.get('id')} name:{p.get('name')} price:RM {p.get('price')} categories:{(p.get('categories') or [])} colors:{colors}"
+
+def build_product_summary(features, token_budget=None):
+    # Precomputed lines of the given products, in order, until the budget runs out
+    lines = []
+    used = 0
+    for f in features:
+        if token_budget is not None and used + f.summary_tokens > token_budget:
+            break
+        lines.append(f.summary)
+        used += f.summary_tokens
     return "\n".join(lines)
 
-def build_prompt(mode, payload, products):
-    product_summary = build_product_summary(products)
+# Invariant instructions come first and the request's preferences last, so
+# only the catalog lines and the preference line are built per request (and
+# consecutive prompts share the longest possible prefix)
+PROMPT_FORMAT = (
+    "Return STRICT JSON: {\"suggestions\": [{\"id\": string, \"justification\": string}]}. "
+    "Justifications must be confident luxury tone, grounding on palette/silhouette/craft and price.\n"
+)
+PROMPT_INSTRUCTIONS = {
+    'mirror': (
+        "You are a luxury fashion client advisor. From the product catalog list below, "
+        "select up to 6 products that harmonize with the client's wardrobe palette and everyday utility. "
+        + PROMPT_FORMAT + "Catalog: \n"
+    ),
+    'copilot': (
+        "You are a luxury fashion client advisor. Build a curated shortlist: from the catalog below, "
+        "select up to 6 products aligned to the client's occasion, palette and budget. "
+        + PROMPT_FORMAT + "Catalog: \n"
+    ),
+}
+PROMPT_INSTRUCTION_TOKENS = { mode: estimate_tokens(text) for mode, text in PROMPT_INSTRUCTIONS.items() }
+
+def preference_line(mode, payload):
     if mode == 'mirror':
-        colors = payload.get('colors') or []
-        return (
-            "You are a luxury fashion client advisor. Given wardrobe color cues: \n"
-            f"colors={colors}\n"
-            "and the following product catalog list: \n"
-            f"{product_summary}\n"
-            "Select up to 6 products that harmonize with the wardrobe palette and everyday utility. "
-            "Return STRICT JSON: {\"suggestions\": [{\"id\": string, \"justification\": string}]}. "
-            "Justifications must be confident luxury tone, grounding on palette/silhouette/craft and price."
-        )
-    else:
-        occ = payload.get('occasion')
-        pal = payload.get('palette')
-        budget = payload.get('budget')
-        return (
-            "You are a luxury fashion client advisor. Build a curated shortlist.\n"
-            f"occasion={occ} palette={pal} budget=RM {budget}\n"
-            "Catalog: \n"
-            f"{product_summary}\n"
-            "Select up to 6 products aligned to the occasion, palette and budget. "
-            "Return STRICT JSON: {\"suggestions\": [{\"id\": string, \"justification\": string}]}. "
-            "Justifications must be confident luxury tone, grounding on palette/silhouette/craft and price."
-        )
-
-def fallback_select(mode, payload, products):
-    def min_price(p):
-        variants = p.get('variants') or []
-        mp = p.get('price') or 0
-        for v in variants:
-            try:
-                mp = min(mp if mp else float('inf'), float(v.get('price') or 0))
-            except Exception:
-                pass
-        return float(mp or 0)
-    picks = []
+        return f"\nWardrobe color cues: colors={payload.get('colors') or []}"
+    return f"\nClient brief: occasion={payload.get('occasion')} palette={payload.get('palette')} budget=RM {payload.get('budget')}"
+
+def build_prompt(mode, payload, features, token_limit=PROMPT_TOKEN_LIMIT):
+    # `features` are the retrieved candidates, best first; the catalog part
+    # gets whatever the instructions and preferences leave of the limit
+    mode = mode if mode == 'mirror' else 'copilot'
+    prefs = preference_line(mode, payload)
+    summary = build_product_summary(features, token_limit - PROMPT_INSTRUCTION_TOKENS[mode] - estimate_tokens(prefs))
+    return PROMPT_INSTRUCTIONS[mode] + summary + prefs
+
+def get_model():
+    # One client for the process, created on first use and shared by the
+    # handler threads; None without an API key
+    global _MODEL
+    if _MODEL is None and API_KEY:
+        with _MODEL_LOCK:
+            if _MODEL is None:
+                _MODEL = genai.GenerativeModel(MODEL_NAME)
+    return _MODEL
+
+def rank_products(mode, prefs, catalog, k=6, vectorized=True):
+    # Deterministic ranking -> top-k ProductFeatures, vectorized when NumPy is available
+    features = catalog.features
+    scoring = catalog.scoring() if vectorized else None
+    weights = (prefs.get('colors') if mode == 'mirror' else prefs.get('palette')) or {}
+    occ = prefs.get('occasion')
+    budget = prefs['budget'] if prefs.get('budget') is not None else float('inf')
+    if scoring is not None:
+        if mode == 'mirror':
+            return [features[i] for i in scoring.mirror(weights, k)]
+        return [features[i] for i in scoring.copilot(occ, budget, weights, k)]
     if mode == 'mirror':
-        colors = [str(c).lower() for c in (payload.get('colors') or [])]
-        scored = []
-        for p in products:
-            variant_colors = []
-            for v in (p.get('variants') or []):
-                opt = v.get('options') or {}
-                c = opt.get('Color') or opt.get('color')
-                if c:
-                    variant_colors.append(str(c).lower())
-            score = 0
-            for c in colors:
-                if c in variant_colors:
-                    score += 2
-            if 'Bags' in (p.get('categories') or []):
-                score += 1
-            scored.append((score, p))
-        scored.sort(key=lambda x: x[0], reverse=True)
-        for _, p in scored[:6]:
-            picks.append({'id': p.get('id'), 'justification': f"Palette harmony and refined utility. RM {min_price(p):.2f}."})
-    else:
-        occ = (payload.get('occasion') or '').lower()
-        pal = (payload.get('palette') or '').lower()
-        budget = float(payload.get('budget') or 1e9)
-        filtered = []
-        for p in products:
-            cats = p.get('categories') or []
-            ok = True
-            if occ == 'work':
-                ok = ('Tote' in cats) or ('Sling' in cats)
-            elif occ == 'casual':
-                ok = ('Pouch' in cats) or ('Sling' in cats)
-            elif occ == 'evening':
-                ok = ('Sling' in cats)
-            if ok and (min_price(p) <= budget):
-                filtered.append(p)
-        filtered.sort(key=min_price)
-        for p in filtered[:6]:
-            picks.append({'id': p.get('id'), 'justification': f"Occasion-ready silhouette with palette alignment. RM {min_price(p):.2f}."})
-    return {'suggestions': picks}
+        return heapq.nlargest(k, features, key=lambda f: 2 * palette_weight(weights, f) + (1 if 'bags' in f.categories else 0))
+    # Copilot: eligible by occasion and budget; best palette match, then cheapest
+    eligible = (f for f in features if (occ not in OCCASION_CATEGORIES or occ in f.occasions) and f.min_price <= budget)
+    return heapq.nsmallest(k, eligible, key=lambda f: (-palette_weight(weights, f), f.min_price))
+
+def fallback_select(mode, prefs, catalog):
+    ranked = rank_products(mode, prefs, catalog)
+    if mode == 'mirror':
+        return {'suggestions': [
+            {'id': f.id, 'justification': f"Palette harmony and refined utility. RM {f.min_price:.2f}."} for f in ranked]}
+    return {'suggestions': [
+        {'id': f.id, 'justification': f"Occasion-ready silhouette with palette alignment. RM {f.min_price:.2f}."} for f in ranked]}
 
 class Handler(BaseHTTPRequestHandler):
+    def _json(self, code, data):
+        self._set_headers(code)
+        self.wfile.write(json.dumps(data).encode('utf-8'))
+
     def _set_headers(self, code=200):
         self.send_response(code)
         self.send_header('Content-Type', 'application/json')
@@ -121,15 +464,20 @@ class Handler(BaseHTTPRequestHandler):
         parsed = urlparse(self.path)
         if parsed.path == '/health':
             self._set_headers(200)
-            self.wfile.write(json.dumps({'ok': True}).encode('utf-8'))
+            self.wfile.write(json.dumps({'ok': True, 'cache': _CACHE.stats()}).encode('utf-8'))
             return
+        if parsed.path == '/catalog':
+            catalog = CATALOG.current()
+            if catalog is None:
+                return self._json(503, {'error': 'catalog_unavailable'})
+            return self._json(200, {'version': catalog.version, 'count': len(catalog.products), 'versions': CATALOG.versions()})
         if parsed.path == '/suggest':
             # Informational message for GET on suggest
             self._set_headers(501)
             self.wfile.write(json.dumps({'error': 'use POST /suggest'}).encode('utf-8'))
             return
         self._set_headers(200)
-        self.wfile.write(json.dumps({'service': 'reweave-suggest', 'endpoints': ['/suggest (POST)', '/health (GET)']}).encode('utf-8'))
+        self.wfile.write(json.dumps({'service': 'reweave-suggest', 'endpoints': ['/suggest (POST)', '/catalog (GET)', '/health (GET)']}).encode('utf-8'))
 
     def do_POST(self):
         parsed = urlparse(self.path)
@@ -146,34 +494,49 @@ class Handler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps({'error': 'bad_request'}).encode('utf-8'))
             return
         mode = payload.get('mode') or 'copilot'
-        products = payload.get('products') or []
-        if not products:
-            self._set_headers(400)
-            self.wfile.write(json.dumps({'error': 'products_required'}).encode('utf-8'))
-            return
-        # Try GenAI selection with simple cache
-        suggestions = None
-        cache_key = json.dumps({'mode': mode, 'payload': payload, 'count': len(products)})
-        global _CACHE
-        if cache_key in _CACHE:
-            suggestions = _CACHE[cache_key]
+        if payload.get('products'):
+            # Older clients still send the catalog with every request
+            catalog = Catalog(payload['products'])
+        else:
+            catalog = CATALOG.get(payload.get('catalogVersion'))
+            if catalog is None:
+                current = CATALOG.current()
+                if current is None:
+                    return self._json(503, {'error': 'catalog_unavailable'})
+                return self._json(409, {'error': 'unknown_catalog_version', 'catalogVersion': current.version})
+        # A cached answer skips the model entirely
+        prefs = normalize_prefs(mode, payload)
+        key = cache_key(mode, prefs, catalog.version)
+        suggestions = _CACHE.get(key)
+        if suggestions is not None:
+            return self._json(200, dict(suggestions, catalogVersion=catalog.version))
+        model_failed = False
         try:
-            if API_KEY:
-                model = genai.GenerativeModel(MODEL_NAME)
-                prompt = build_prompt(mode, payload, products)
+            # Retrieval: only the best deterministic matches reach the prompt,
+            # and none at all means there is nothing to ask the model
+            model = get_model()
+            candidates = rank_products(mode, prefs, catalog, k=PROMPT_CANDIDATES) if model else []
+            if candidates:
+                prompt = build_prompt(mode, payload, candidates)
                 resp = model.generate_content(prompt)
                 txt = (resp.text or '').strip()
                 data = json.loads(txt)
+                if not isinstance(data, dict):
+                    raise ValueError('model returned no JSON object')
                 suggestions = data
         except Exception:
             suggestions = None
+            model_failed = True
         if not suggestions:
-            suggestions = fallback_select(mode, payload, products)
-        _CACHE[cache_key] = suggestions
-        self._set_headers(200)
-        self.wfile.write(json.dumps(suggestions).encode('utf-8'))
+            suggestions = fallback_select(mode, prefs, catalog)
+        # A fallback after a model error isn't cached, so the next request retries
+        if not model_failed:
+            _CACHE.put(key, suggestions)
+        self._json(200, dict(suggestions, catalogVersion=catalog.version))
 
 def run(host='127.0.0.1', port=3002):
+    CATALOG.reload()
+    get_model()
     server = ThreadingHTTPServer((host, port), Handler)
     print(f"Suggest server listening on http://{host}:{port}")
     try:
@@ -184,6 +547,3 @@ def run(host='127.0.0.1', port=3002):
 
 if __name__ == '__main__':
     run()
-
-# Simple in-memory cache
-_CACHE = {}
\ No newline at end of file
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# Benchmarks for the Python backend. Run from archive/backend-files, the
+# directory server.py resolves backend/data against:
+#   python backend/bench.py serve --workers 0,1,2,4,8 --endpoint login
+#   python backend/bench.py events --batch 20 --concurrency 8
+#   python backend/bench.py checkout --stock 50 --concurrency 16
+# Every run works on a throwaway copy of backend/data.
+import argparse
+import http.client
+import importlib
+import itertools
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, 'server.py')
+BENCH_EMAIL = 'bench@reweave.test'
+BENCH_PASSWORD = 'bench-password'
+
+ENDPOINTS = {
+    'health': ('GET', '/api/health', None),
+    'products': ('GET', '/api/products', None),
+    'login': ('POST', '/api/auth/login', { 'email': BENCH_EMAIL, 'password': BENCH_PASSWORD }),
+    'metrics': ('GET', '/api/analytics/metrics', None),
+    'product': ('GET', '/api/products/luxe-mini', None),
+    'inventory': ('GET', '/api/inventory/LM-SNG-001', None),
+}
+
+def make_workdir():
+    workdir = tempfile.mkdtemp(prefix='reweave-bench-')
+    shutil.copytree(os.path.join(HERE, 'data'), os.path.join(workdir, 'backend', 'data'),
+                    ignore=shutil.ignore_patterns('*.jsonl', '*.tmp'))
+    return workdir
+
+def request(conn, method, path, body=None):
+    payload = json.dumps(body).encode('utf-8') if body is not None else None
+    headers = { 'Content-Type': 'application/json' } if payload else {}
+    conn.request(method, path, body=payload, headers=headers)
+    resp = conn.getresponse()
+    data = resp.read()
+    return resp.status, data
+
+def start_server(workdir, port, workers, env=None):
+    proc = subprocess.Popen(
+        [sys.executable, SERVER, '--port', str(port), '--workers', str(workers)],
+        cwd=workdir, env=dict(os.environ, **(env or {})),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('localhost', port, timeout=2)
+            status, _ = request(conn, 'GET', '/api/health')
+            conn.close()
+            if status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+def client_loop(port, method, path, body, duration):
+    # One keep-alive connection issuing requests back to back
+    conn = http.client.HTTPConnection('localhost', port, timeout=30)
+    latencies = []
+    errors = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        t0 = time.perf_counter()
+        try:
+            status, _ = request(conn, method, path, body)
+            if status >= 500:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('localhost', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - t0)
+    conn.close()
+    return latencies, errors
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def run_load(port, method, path, body, concurrency, duration):
+    # Clients run in separate processes so the load generator isn't GIL-bound
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(client_loop, port, method, path, body, duration) for _ in range(concurrency)]
+        results = [f.result() for f in futures]
+    latencies = [l for lat, _ in results for l in lat]
+    errors = sum(e for _, e in results)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+def bench_serve(args):
+    method, path, body = ENDPOINTS[args.endpoint]
+    print(f'endpoint={args.endpoint} concurrency={args.concurrency} duration={args.duration}s cpus={os.cpu_count()}')
+    print(f"{'workers':>8} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for workers in [int(w) for w in args.workers.split(',')]:
+        workdir = make_workdir()
+        proc = start_server(workdir, args.port, workers)
+        try:
+            if args.endpoint == 'login':
+                conn = http.client.HTTPConnection('localhost', args.port)
+                request(conn, 'POST', '/api/auth/signup', { 'email': BENCH_EMAIL, 'password': BENCH_PASSWORD })
+                conn.close()
+            r = run_load(args.port, method, path, body, args.concurrency, args.duration)
+        finally:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"{workers:>8} {r['rps']:>10.1f} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['errors']:>7}")
+
+def event_client_loop(port, batch, duration):
+    # Posts batches of tracker-shaped events; counts accepted events and 429s
+    conn = http.client.HTTPConnection('localhost', port, timeout=30)
+    events = [{ 'event': 'page_view', 'timestamp': 0, 'session_id': 'bench', 'page': f'/p{i}' } for i in range(batch)]
+    latencies = []
+    accepted = throttled = errors = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        t0 = time.perf_counter()
+        try:
+            status, data = request(conn, 'POST', '/api/events/batch', { 'events': events })
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('localhost', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - t0)
+        if status == 202:
+            accepted += json.loads(data)['accepted']
+        elif status == 429:
+            throttled += 1
+        else:
+            errors += 1
+    conn.close()
+    return latencies, accepted, throttled, errors
+
+def bench_events(args):
+    print(f'batch={args.batch} concurrency={args.concurrency} duration={args.duration}s buffer={args.buffer} cpus={os.cpu_count()}')
+    workdir = make_workdir()
+    env = { 'REWEAVE_EVENT_BUFFER': str(args.buffer) }
+    proc = start_server(workdir, args.port, args.workers, env)
+    try:
+        conn = http.client.HTTPConnection('localhost', args.port)
+        _, data = request(conn, 'GET', '/api/events')
+        before = json.loads(data)['count']
+        with ProcessPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(event_client_loop, args.port, args.batch, args.duration) for _ in range(args.concurrency)]
+            results = [f.result() for f in futures]
+        time.sleep(1)
+        conn.close()
+        conn = http.client.HTTPConnection('localhost', args.port)
+        _, data = request(conn, 'GET', '/api/events')
+        stored = json.loads(data)['count'] - before
+        conn.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    latencies = [l for r in results for l in r[0]]
+    accepted = sum(r[1] for r in results)
+    print(f'requests      {len(latencies):>10}')
+    print(f'events/s      {accepted / args.duration:>10.1f}')
+    print(f'p50 / p99 ms  {percentile(latencies, 50) * 1000:>6.1f} / {percentile(latencies, 99) * 1000:.1f}')
+    print(f'429 responses {sum(r[2] for r in results):>10}')
+    print(f'errors        {sum(r[3] for r in results):>10}')
+    print(f'stored        {stored:>10} of {accepted} accepted')
+
+def checkout_client_loop(port, sku, attempts):
+    # Single-unit checkouts of one sku; counts placed orders and 409s
+    conn = http.client.HTTPConnection('localhost', port, timeout=30)
+    cart = { 'items': [{ 'sku': sku, 'quantity': 1 }], 'currency': 'MYR' }
+    placed, sold_out, errors = [], 0, 0
+    for _ in range(attempts):
+        try:
+            status, data = request(conn, 'POST', '/api/checkout', cart)
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('localhost', port, timeout=30)
+            continue
+        if status == 200:
+            placed.append(json.loads(data)['orderId'])
+        elif status == 409:
+            sold_out += 1
+        else:
+            errors += 1
+    conn.close()
+    return placed, sold_out, errors
+
+def checkout_round(port, sku, concurrency, attempts):
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(checkout_client_loop, port, sku, attempts) for _ in range(concurrency)]
+        results = [f.result() for f in futures]
+    return [o for r in results for o in r[0]], sum(r[1] for r in results), sum(r[2] for r in results)
+
+def stock_state(db_path, sku):
+    conn = sqlite3.connect(db_path)
+    try:
+        stock = conn.execute("SELECT stock FROM variants WHERE sku = ?", (sku,)).fetchone()[0]
+        held = conn.execute(
+            "SELECT COALESCE(SUM(qty), 0) FROM stock_reservations WHERE sku = ? AND released_at IS NULL", (sku,)).fetchone()[0]
+        orders = conn.execute("SELECT COUNT(*) FROM stock_reservations WHERE sku = ?", (sku,)).fetchone()[0]
+    finally:
+        conn.close()
+    return stock, held, orders
+
+def bench_checkout(args):
+    # Oversell check: more concurrent buyers than stock for one sku, then fail
+    # some payments and sell the released units again
+    print(f'sku={args.sku} stock={args.stock} concurrency={args.concurrency} attempts={args.attempts} cpus={os.cpu_count()}')
+    workdir = make_workdir()
+    db_path = os.path.join(workdir, 'backend', 'data', 'reweave.db')
+    proc = start_server(workdir, args.port, args.workers)
+    try:
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE variants SET stock = ? WHERE sku = ?", (args.stock, args.sku))
+        conn.commit()
+        conn.close()
+        t0 = time.perf_counter()
+        placed, sold_out, errors = checkout_round(args.port, args.sku, args.concurrency, args.attempts)
+        elapsed = time.perf_counter() - t0
+        stock, held, _ = stock_state(db_path, args.sku)
+        print(f'round 1       {len(placed):>6} placed  {sold_out:>6} sold out  {errors} errors  {elapsed:.2f}s')
+        print(f'              stock {stock}, held {held}')
+        ok = len(placed) == args.stock and stock == 0 and held == args.stock and errors == 0
+
+        failed = placed[:args.fail]
+        conn = http.client.HTTPConnection('localhost', args.port)
+        for order_id in failed:
+            request(conn, 'POST', '/api/fpx/webhook', { 'orderId': order_id, 'status': 'failed', 'transactionId': f'bench-{order_id}' })
+        conn.close()
+        deadline = time.time() + 10
+        while time.time() < deadline and stock_state(db_path, args.sku)[0] != len(failed):
+            time.sleep(0.1)
+        stock, held, _ = stock_state(db_path, args.sku)
+        print(f'failed        {len(failed):>6} payments -> stock {stock}, held {held}')
+        ok = ok and stock == len(failed) and held == args.stock - len(failed)
+
+        placed2, sold_out, errors = checkout_round(args.port, args.sku, args.concurrency, args.attempts)
+        stock, held, orders = stock_state(db_path, args.sku)
+        print(f'round 2       {len(placed2):>6} placed  {sold_out:>6} sold out  {errors} errors')
+        print(f'              stock {stock}, held {held}, orders {orders}')
+        ok = ok and len(placed2) == len(failed) and stock == 0 and held == args.stock and errors == 0
+        ok = ok and orders == len(set(placed + placed2))
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print('no oversell' if ok else 'OVERSOLD OR LOST STOCK')
+    if not ok:
+        sys.exit(1)
+
+def load_server(workdir):
+    # Import server.py against a throwaway data dir (it resolves backend/data
+    # relative to the working directory at import time)
+    os.chdir(workdir)
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    return importlib.import_module('server')
+
+def build_catalog_db(path, products, variants_per_product, file_variants=0):
+    # Synthetic catalog; file_variants of each product's variants are also in data_json
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS products (id TEXT PRIMARY KEY, data_json TEXT NOT NULL)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS variants (sku TEXT PRIMARY KEY, product_id TEXT NOT NULL,
+        price REAL NOT NULL, stock INTEGER DEFAULT 0, options_json TEXT)""")
+    for p in range(products):
+        pid = f'prod-{p:05d}'
+        variants = []
+        for v in range(variants_per_product):
+            options = { 'Color': f'c{v % 10}', 'Size': f's{v // 10 % 5}', 'Strap': f't{v // 50}' }
+            variants.append({ 'sku': f'{pid}-{v:04d}', 'price': 100 + v, 'stock': 5, 'options': options })
+        data = { 'id': pid, 'name': f'Product {p}', 'variants': variants[:file_variants] }
+        conn.execute("INSERT INTO products VALUES (?,?)", (pid, json.dumps(data)))
+        conn.executemany("INSERT INTO variants VALUES (?,?,?,?,?)",
+                         [(v['sku'], pid, v['price'], v['stock'], json.dumps(v['options'])) for v in variants])
+    conn.commit()
+    conn.close()
+
+def legacy_get_products(db_path):
+    # The pre-rewrite loader: linear any() duplicate check per variant row
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("SELECT id, data_json FROM products")
+    prod_map = { r['id']: json.loads(r['data_json']) for r in cur.fetchall() }
+    cur.execute("SELECT sku, product_id, price, stock, options_json FROM variants")
+    for r in cur.fetchall():
+        p = prod_map.get(r['product_id'])
+        if not p:
+            continue
+        vs = p.get('variants') or []
+        variant = { 'sku': r['sku'], 'price': r['price'], 'stock': r['stock'], 'options': json.loads(r['options_json'] or '{}') }
+        if not any((v.get('sku') == variant['sku']) for v in vs):
+            vs.append(variant)
+        p['variants'] = vs
+    conn.close()
+    return list(prod_map.values())
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+def bench_archive(args):
+    # Synthetic event archive; reads should cost the same at any archive size
+    workdir = make_workdir()
+    try:
+        server = load_server(workdir)
+        path = os.path.join(workdir, 'archive')
+        start = 1_700_000_000_000
+        step = args.days * 86_400_000 // args.events
+        types = ['page_view', 'add_to_cart', 'swatch_change', 'checkout_initiate', 'sticky_show']
+        events = ({ 'id': f'evt_{start + i * step}', 'type': types[i % len(types)], 'payload': { 'page': f'/p{i % 50}' },
+                    'ts': start + i * step, 'ua': f'Mozilla/5.0 bench-{i % 20}' } for i in range(args.events))
+        t0 = time.perf_counter()
+        archive = server.EventArchive(path, [])
+        archive.replace_all(events)
+        print(f'events={args.events} days={args.days} build {time.perf_counter() - t0:.1f}s '
+              f'on disk {sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) / 1e6:.1f} MB')
+        archive = server.EventArchive(path, [])
+        mid = start + args.days // 2 * 86_400_000
+        cases = [
+            ('summary (all)', lambda: archive.summary()),
+            ('summary (1 day)', lambda: archive.summary(mid, mid + 86_400_000)),
+            ('latest 50', lambda: list(itertools.islice(archive.scan(order='desc'), 50))),
+            ('1 hour, 1 type, 50', lambda: list(itertools.islice(archive.scan(mid, mid + 3_600_000, {'add_to_cart'}), 50))),
+            ('1 day full scan', lambda: sum(1 for _ in archive.scan(mid, mid + 86_400_000))),
+        ]
+        for name, fn in cases:
+            elapsed, _ = best_of(fn, args.repeat)
+            print(f'{name:<22} {elapsed * 1000:9.2f} ms')
+        print(f'max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def bench_variants(args):
+    workdir = make_workdir()
+    try:
+        db_path = os.path.join(workdir, 'backend', 'data', 'reweave.db')
+        os.remove(db_path)
+        build_catalog_db(db_path, args.products, args.variants, args.file_variants)
+        server = load_server(workdir)
+        server.init_db()
+        print(f'products={args.products} variants/product={args.variants} in data_json={args.file_variants}')
+        legacy, old = best_of(lambda: legacy_get_products(db_path), args.repeat)
+        current, new = best_of(server.get_products_from_db, args.repeat)
+        assert sum(len(p['variants']) for p in old) == sum(len(p['variants']) for p in new)
+        print(f'legacy any() merge   {legacy * 1000:9.1f} ms')
+        print(f'sku-keyed merge      {current * 1000:9.1f} ms  ({legacy / current:.1f}x)')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reweave backend benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('serve', help='requests/sec against a live server per worker count')
+    p.add_argument('--workers', default='0,1,2,4,8', help='comma-separated worker counts (0 = single-threaded)')
+    p.add_argument('--endpoint', choices=sorted(ENDPOINTS), default='login')
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--duration', type=float, default=5.0)
+    p.add_argument('--port', type=int, default=3951)
+    p.set_defaults(func=bench_serve)
+
+    p = sub.add_parser('events', help='sustained POST /api/events/batch ingestion')
+    p.add_argument('--batch', type=int, default=20, help='events per request')
+    p.add_argument('--buffer', type=int, default=10000, help='REWEAVE_EVENT_BUFFER for the server')
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--duration', type=float, default=5.0)
+    p.add_argument('--port', type=int, default=3951)
+    p.set_defaults(func=bench_events)
+
+    p = sub.add_parser('checkout', help='concurrent checkouts racing for limited stock')
+    p.add_argument('--sku', default='LM-SNG-001')
+    p.add_argument('--stock', type=int, default=50)
+    p.add_argument('--fail', type=int, default=10, help='payments failed after the first round')
+    p.add_argument('--attempts', type=int, default=20, help='checkouts per client')
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--port', type=int, default=3951)
+    p.set_defaults(func=bench_checkout)
+
+    p = sub.add_parser('archive', help='event archive scans and summaries on a synthetic history')
+    p.add_argument('--events', type=int, default=1_000_000)
+    p.add_argument('--days', type=int, default=365)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser('variants', help='get_products_from_db variant merge on a synthetic catalog')
+    p.add_argument('--products', type=int, default=1000)
+    p.add_argument('--variants', type=int, default=200)
+    p.add_argument('--file-variants', type=int, default=0, help='variants per product already present in data_json')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_variants)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
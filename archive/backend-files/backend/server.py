@@ -1,14 +1,36 @@
 #!/usr/bin/env python3
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import json
 import os
 import hashlib
 import secrets
+import shutil
 import base64
+import bisect
+import collections
+import copy
+import csv
+import gzip
+import io
+import itertools
+import queue
 import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
 from urllib.parse import urlparse, parse_qs
 
 PORT = int(os.environ.get('PORT', '3001'))
+# Request worker threads; 0 serves everything on the accept thread
+WORKERS = int(os.environ.get('REWEAVE_WORKERS', str(min(32, (os.cpu_count() or 1) * 4))))
+# Accepted connections allowed to wait for a free worker
+MAX_PENDING = int(os.environ.get('REWEAVE_MAX_PENDING', '64'))
+SESSION_TTL_MS = int(os.environ.get('REWEAVE_SESSION_TTL_HOURS', str(24 * 30))) * 3600 * 1000
+SESSION_PRUNE_INTERVAL = float(os.environ.get('REWEAVE_SESSION_PRUNE_SECONDS', '300'))
+KEEPALIVE_TIMEOUT = float(os.environ.get('REWEAVE_KEEPALIVE_TIMEOUT', '5'))
 DATA_DIR = os.path.join('backend', 'data')
 LEADS_FILE = os.path.join(DATA_DIR, 'leads.json')
 EVENTS_FILE = os.path.join(DATA_DIR, 'events.json')
@@ -25,38 +47,1213 @@ for f in (LEADS_FILE, EVENTS_FILE, USERS_FILE, SESSIONS_FILE, ORDERS_FILE, PRODU
         with open(f, 'w') as wf:
             json.dump([], wf)
 
-def read_leads():
+# --- Record storage ---
+# Leads, events and orders go through a pluggable engine selected with
+# REWEAVE_STORAGE: 'log' (default) keeps an append-only JSON-lines segment
+# next to the legacy file, 'json' keeps the original whole-array JSON file.
+STORAGE_ENGINE = os.environ.get('REWEAVE_STORAGE', 'log')
+# Compact a segment once superseded lines outnumber both this and the live records
+COMPACT_MIN_GARBAGE = int(os.environ.get('REWEAVE_COMPACT_MIN_GARBAGE', '1000'))
+
+def atomic_write_json(path, payload, indent=2):
+    # Write to a temp file and rename so readers never observe a partial file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(payload, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# Stores report every change to their observers as fn(old, new) while still
+# holding the store lock: old is None for inserts, new is None for deletes and
+# both are None when the whole collection was replaced.
+class ObservableStore:
+    _observers = ()
+
+    def observe(self, fn):
+        self._observers = self._observers + (fn,)
+
+    def _notify(self, old, new):
+        for fn in self._observers:
+            fn(old, new)
+
+# Original engine: the whole collection is one JSON array, rewritten on every write
+class JsonArrayStore(ObservableStore):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+
+    def all(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except Exception:
+            return []
+
+    def get(self, record_id):
+        return next((r for r in self.all() if r.get('id') == record_id), None)
+
+    def count(self):
+        return len(self.all())
+
+    def page(self, after=None, limit=100, reverse=False):
+        records = self.all()
+        if reverse:
+            records.reverse()
+        start = 0
+        if after is not None:
+            start = next((i + 1 for i, r in enumerate(records) if r.get('id') == after), len(records))
+        return records[start:start + limit]
+
+    def append(self, record):
+        with self._lock:
+            records = self.all()
+            records.append(record)
+            atomic_write_json(self.path, records)
+            self._notify(None, record)
+        return record
+
+    def put(self, record):
+        with self._lock:
+            records = self.all()
+            old = None
+            for i, r in enumerate(records):
+                if r.get('id') == record.get('id'):
+                    old = r
+                    records[i] = record
+                    break
+            else:
+                records.append(record)
+            atomic_write_json(self.path, records)
+            self._notify(old, record)
+        return record
+
+    def replace_all(self, records):
+        with self._lock:
+            atomic_write_json(self.path, list(records))
+            self._notify(None, None)
+
+    def sync(self):
+        # Every write above is already durable
+        pass
+
+# Append-only JSON-lines segment with an in-memory id -> record index.
+# Every write appends one line, so appends are O(1) regardless of history.
+# Ids are also kept in first-write order with their positions, which gives
+# keyset pagination (resume after an id) without scanning.
+# Updates append a newer version under the same id and the index keeps the
+# latest; compaction rewrites the live records to a temp file and renames it
+# over the segment, so readers never see a half-written file.
+class LogStore(ObservableStore):
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._records = {}
+        self._order = []
+        self._pos = {}
+        self._garbage = 0
+        self._dirty = False
+        self._fh = None
+        self._load(legacy_path)
+
+    def _load(self, legacy_path):
+        if not os.path.exists(self.path):
+            # First start on this engine: import the legacy JSON array once
+            legacy = []
+            if legacy_path and os.path.exists(legacy_path):
+                try:
+                    with open(legacy_path, 'r') as f:
+                        legacy = json.load(f) or []
+                except Exception:
+                    legacy = []
+            for r in legacy:
+                self._index(r)
+            self._rewrite()
+            return
+        torn = False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # Partial trailing line from an interrupted append
+                    torn = True
+                    break
+                try:
+                    self._index(json.loads(line))
+                except Exception:
+                    torn = True
+        if torn:
+            self._rewrite()
+        else:
+            self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def _index(self, record):
+        rid = record.get('id')
+        if rid in self._records:
+            self._garbage += 1
+        else:
+            self._pos[rid] = len(self._order)
+            self._order.append(rid)
+        self._records[rid] = record
+
+    def _rewrite(self):
+        if self._fh:
+            self._fh.close()
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for r in self._records.values():
+                f.write(json.dumps(r) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._garbage = 0
+        self._dirty = False
+        self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def _write(self, record):
+        # Buffered only; the writer makes the batch durable with sync()
+        old = self._records.get(record.get('id'))
+        self._index(record)
+        self._fh.write(json.dumps(record) + '\n')
+        self._dirty = True
+        if self._garbage > max(COMPACT_MIN_GARBAGE, len(self._records)):
+            self._rewrite()
+        self._notify(old, record)
+
+    def all(self):
+        with self._lock:
+            return list(self._records.values())
+
+    def get(self, record_id):
+        with self._lock:
+            return self._records.get(record_id)
+
+    def count(self):
+        return len(self._records)
+
+    def page(self, after=None, limit=100, reverse=False):
+        # Up to `limit` records following the id `after` in write order (or
+        # reverse write order); an unknown id yields an empty page
+        with self._lock:
+            n = len(self._order)
+            if reverse:
+                start = n - 1 if after is None else self._pos.get(after, 0) - 1
+                ids = self._order[max(start - limit + 1, 0):start + 1][::-1] if start >= 0 else []
+            else:
+                start = 0 if after is None else self._pos.get(after, n - 1) + 1
+                ids = self._order[start:start + limit]
+            return [self._records[rid] for rid in ids]
+
+    def append(self, record):
+        with self._lock:
+            self._write(record)
+        return record
+
+    def put(self, record):
+        return self.append(record)
+
+    def replace_all(self, records):
+        with self._lock:
+            self._records = {}
+            self._order = []
+            self._pos = {}
+            for r in records:
+                self._index(r)
+            self._rewrite()
+            self._notify(None, None)
+
+    def compact(self):
+        with self._lock:
+            self._rewrite()
+
+    def sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._dirty = False
+
+# Whole-document JSON list (users, sessions, OTPs) held in memory. Writes only
+# mark it dirty; the writer persists it once per batch with an atomic rename.
+# Records are hashed by their primary field (or by identity when there is
+# none) and optionally by unique secondary fields, so lookups are O(1) and the
+# indexes are updated on every write rather than rebuilt on read.
+class JsonDocStore(ObservableStore):
+    def __init__(self, path, indent=2, primary='id', unique=()):
+        self.path = path
+        self.indent = indent
+        self.primary = primary
+        self.unique = tuple(unique)
+        self._lock = threading.RLock()
+        self._dirty = False
+        try:
+            with open(path, 'r') as f:
+                records = json.load(f)
+        except Exception:
+            records = []
+        self._load(records)
+
+    def _key(self, record):
+        return record.get(self.primary) if self.primary else id(record)
+
+    def _load(self, records):
+        self._records = {}
+        self._unique = { field: {} for field in self.unique }
+        for r in records:
+            self._add(r)
+
+    def _add(self, record):
+        old = self._records.get(self._key(record))
+        if old is not None:
+            self._drop(old)
+        self._records[self._key(record)] = record
+        for field, index in self._unique.items():
+            if record.get(field) is not None:
+                index[record[field]] = record
+
+    def _drop(self, record):
+        self._records.pop(self._key(record), None)
+        for field, index in self._unique.items():
+            if index.get(record.get(field)) is record:
+                del index[record[field]]
+
+    def all(self):
+        with self._lock:
+            return list(self._records.values())
+
+    def get(self, key):
+        with self._lock:
+            return self._records.get(key)
+
+    def count(self):
+        return len(self._records)
+
+    def find(self, field, value):
+        with self._lock:
+            return self._unique[field].get(value)
+
+    def append(self, record):
+        with self._lock:
+            old = self._records.get(self._key(record))
+            self._add(record)
+            self._dirty = True
+            self._notify(old, record)
+        return record
+
+    def put(self, record):
+        return self.append(record)
+
+    def delete(self, key):
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                return 0
+            self._drop(record)
+            self._dirty = True
+            self._notify(record, None)
+        return 1
+
+    def remove(self, predicate):
+        with self._lock:
+            matches = [r for r in self._records.values() if predicate(r)]
+            for r in matches:
+                self._drop(r)
+                self._notify(r, None)
+            if matches:
+                self._dirty = True
+        return len(matches)
+
+    def replace_all(self, records):
+        with self._lock:
+            self._load(records)
+            self._dirty = True
+            self._notify(None, None)
+
+    def sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = list(self._records.values())
+            self._dirty = False
+        atomic_write_json(self.path, snapshot, self.indent)
+
+# --- Event archive ---
+# Events are append-only and read by time range, so they get their own engine:
+# one partition per UTC day under data/events/. The current day is "hot": rows
+# are appended to <day>.jsonl and mirrored in memory as columns. Older days are
+# sealed by a background task into <day>.evc, a gzipped JSON document holding
+# one array per column sorted by (ts, id), with `type` and `ua`
+# dictionary-encoded (each distinct value stored once, rows hold its index).
+# manifest.json keeps every sealed partition's row count, time bounds and type
+# counts, so summaries and partition pruning never open a partition file. Only
+# hot partitions and a small LRU of decoded sealed ones stay in memory.
+EVENTS_DIR = os.path.join(DATA_DIR, 'events')
+EVENT_PARTITION_CACHE = int(os.environ.get('REWEAVE_EVENT_PARTITION_CACHE', '8'))
+
+def read_legacy_records(paths):
+    # First existing legacy source: a log-engine segment (latest version per
+    # id wins, as it did there) or the original JSON array
+    for p in paths:
+        if not os.path.exists(p):
+            continue
+        try:
+            if p.endswith('.jsonl'):
+                records = {}
+                with open(p, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            r = json.loads(line)
+                        except ValueError:
+                            continue
+                        records[r.get('id')] = r
+                return list(records.values())
+            with open(p, 'r') as f:
+                return json.load(f) or []
+        except Exception:
+            continue
+    return []
+
+def event_ts(e):
     try:
-        with open(LEADS_FILE, 'r') as f:
+        return int(e.get('ts') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def event_day(ts):
+    try:
+        return time.strftime('%Y-%m-%d', time.gmtime(ts / 1000))
+    except (OverflowError, OSError, ValueError):
+        return '1970-01-01'
+
+def event_key(e):
+    # Sort and cursor key
+    return (event_ts(e), str(e.get('id', '')))
+
+class EventPartition:
+    def __init__(self, day):
+        self.day = day
+        self.ids, self.ts, self.type, self.ua, self.payload = [], [], [], [], []
+        self.types, self.uas = [], []
+        self._type_codes, self._ua_codes = {}, {}
+        self.counts = {}
+        self.min_ts = self.max_ts = None
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _code(values, codes, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def add(self, e):
+        ts, rid = event_key(e)
+        if self.ids and (ts, rid) < (self.ts[-1], self.ids[-1]):
+            self.sorted = False
+        self.min_ts = ts if self.min_ts is None else min(self.min_ts, ts)
+        self.max_ts = ts if self.max_ts is None else max(self.max_ts, ts)
+        ev_type = e.get('type') or 'unknown'
+        self.ids.append(rid)
+        self.ts.append(ts)
+        self.type.append(self._code(self.types, self._type_codes, ev_type))
+        self.ua.append(self._code(self.uas, self._ua_codes, e.get('ua') or ''))
+        self.payload.append(e.get('payload', {}))
+        self.counts[ev_type] = self.counts.get(ev_type, 0) + 1
+
+    def row(self, i):
+        return {
+            'id': self.ids[i],
+            'type': self.types[self.type[i]],
+            'payload': self.payload[i],
+            'ts': self.ts[i],
+            'ua': self.uas[self.ua[i]],
+        }
+
+    def meta(self):
+        return { 'count': len(self), 'min_ts': self.min_ts, 'max_ts': self.max_ts, 'counts': dict(self.counts) }
+
+    def to_doc(self):
+        order = sorted(range(len(self)), key=lambda i: (self.ts[i], self.ids[i]))
+        return {
+            'day': self.day,
+            'types': self.types,
+            'uas': self.uas,
+            'id': [self.ids[i] for i in order],
+            'ts': [self.ts[i] for i in order],
+            'type': [self.type[i] for i in order],
+            'ua': [self.ua[i] for i in order],
+            'payload': [self.payload[i] for i in order],
+        }
+
+    @classmethod
+    def from_doc(cls, doc):
+        part = cls(doc['day'])
+        part.types, part.uas = doc['types'], doc['uas']
+        part._type_codes = { v: i for i, v in enumerate(part.types) }
+        part._ua_codes = { v: i for i, v in enumerate(part.uas) }
+        part.ids, part.ts, part.type, part.ua, part.payload = doc['id'], doc['ts'], doc['type'], doc['ua'], doc['payload']
+        for code in part.type:
+            name = part.types[code]
+            part.counts[name] = part.counts.get(name, 0) + 1
+        if part.ts:
+            part.min_ts, part.max_ts = part.ts[0], part.ts[-1]
+        return part
+
+    def positions(self, n, is_sorted, since, until, types, after, reverse):
+        # Row indexes among the first n rows matching the filters, in key order
+        # (descending when reverse), strictly after the cursor key `after`
+        lo_ts, hi_ts = since, until
+        if after is not None:
+            if reverse:
+                hi_ts = after[0] + 1 if hi_ts is None else min(hi_ts, after[0] + 1)
+            else:
+                lo_ts = after[0] if lo_ts is None else max(lo_ts, after[0])
+        if is_sorted:
+            lo = bisect.bisect_left(self.ts, lo_ts, 0, n) if lo_ts is not None else 0
+            hi = bisect.bisect_left(self.ts, hi_ts, 0, n) if hi_ts is not None else n
+            order = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+        else:
+            order = sorted(range(n), key=lambda i: (self.ts[i], self.ids[i]), reverse=reverse)
+        codes = None
+        if types:
+            codes = { self._type_codes[t] for t in types if t in self._type_codes }
+        for i in order:
+            ts = self.ts[i]
+            if (lo_ts is not None and ts < lo_ts) or (hi_ts is not None and ts >= hi_ts):
+                continue
+            if codes is not None and self.type[i] not in codes:
+                continue
+            if after is not None:
+                key = (ts, self.ids[i])
+                if (key >= after) if reverse else (key <= after):
+                    continue
+            yield i
+
+class EventArchive(ObservableStore):
+    def __init__(self, path, legacy_paths=()):
+        self.path = path
+        self._lock = threading.RLock()
+        self._hot = {}
+        self._files = {}
+        self._dirty = set()
+        self._manifest = {}
+        self._cache = collections.OrderedDict()
+        self._totals = {}
+        self._count = 0
+        if not os.path.isdir(path):
+            self._build(path, read_legacy_records(legacy_paths))
+        self._load()
+
+    # --- layout ---
+    def _file(self, day, ext):
+        return os.path.join(self.path, f'{day}.{ext}')
+
+    @staticmethod
+    def _write_partition(path, part, absorbed=0):
+        tmp = f'{path}.tmp'
+        doc = part.to_doc()
+        doc['absorbed'] = absorbed
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+            json.dump(doc, f, separators=(',', ':'))
+        with open(tmp, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _build(self, path, records):
+        # Lay out a complete archive in a temp dir and rename it into place.
+        # One partition is held at a time when records arrive in day order; a
+        # day seen again is read back and extended.
+        tmp = f'{path}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        manifest = {}
+        part = None
+
+        def flush(part):
+            self._write_partition(os.path.join(tmp, f'{part.day}.evc'), part)
+            manifest[part.day] = part.meta()
+
+        for r in records:
+            day = event_day(event_ts(r))
+            if part is None or part.day != day:
+                if part is not None:
+                    flush(part)
+                if day in manifest:
+                    with gzip.open(os.path.join(tmp, f'{day}.evc'), 'rt', encoding='utf-8') as f:
+                        part = EventPartition.from_doc(json.load(f))
+                else:
+                    part = EventPartition(day)
+            part.add(r)
+        if part is not None:
+            flush(part)
+        atomic_write_json(os.path.join(tmp, 'manifest.json'), manifest, None)
+        os.replace(tmp, path)
+
+    def _read_partition(self, day):
+        with gzip.open(self._file(day, 'evc'), 'rt', encoding='utf-8') as f:
             return json.load(f)
-    except Exception:
-        return []
+
+    def _write_manifest(self):
+        atomic_write_json(os.path.join(self.path, 'manifest.json'), self._manifest, None)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, 'manifest.json'), 'r') as f:
+                self._manifest = json.load(f)
+        except Exception:
+            # Lost manifest: rebuild it from the sealed partitions
+            self._manifest = {}
+            for name in os.listdir(self.path):
+                if name.endswith('.evc'):
+                    doc = self._read_partition(name[:-4])
+                    self._manifest[doc['day']] = dict(EventPartition.from_doc(doc).meta(), absorbed=doc.get('absorbed', 0))
+            self._write_manifest()
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.jsonl'):
+                self._load_hot(name[:-6])
+        for _, meta in self._sealed():
+            self._add_totals(meta['counts'], 1)
+        for part in self._hot.values():
+            self._add_totals(part.counts, 1)
+
+    def _load_hot(self, day):
+        path = self._file(day, 'jsonl')
+        sealed = self._manifest.get(day)
+        if sealed and sealed.get('absorbed') == os.path.getsize(path):
+            # Sealed before the segment could be removed
+            os.remove(path)
+            return
+        # A day reopened by a late event keeps its manifest entry until the
+        # next seal; its sealed rows are merged with the segment's. So is an
+        # .evc the manifest never recorded (a seal cut short), skipping rows
+        # it already holds.
+        if sealed or os.path.exists(self._file(day, 'evc')):
+            part = EventPartition.from_doc(self._read_partition(day))
+            self._manifest[day] = dict(sealed or part.meta(), absorbed=-1)
+        else:
+            part = EventPartition(day)
+        seen = set(part.ids)
+        good = []
+        torn = False
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('partial line')
+                    record = json.loads(line)
+                    if record.get('id') is None or record.get('id') not in seen:
+                        part.add(record)
+                    good.append(line)
+                except ValueError:
+                    torn = True
+                    break
+        if torn:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(good)
+                f.flush()
+                os.fsync(f.fileno())
+        self._hot[day] = part
+        self._files[day] = open(path, 'a', encoding='utf-8')
+
+    def _sealed(self):
+        # Manifest entries still served from their .evc; a reopened day is
+        # read and counted through its hot partition instead
+        return [(d, m) for d, m in self._manifest.items() if d not in self._hot]
+
+    def _add_totals(self, counts, sign):
+        for t, n in counts.items():
+            self._totals[t] = self._totals.get(t, 0) + sign * n
+            self._count += sign * n
+            if not self._totals[t]:
+                del self._totals[t]
+
+    def _partition(self, day):
+        # Hot partition, or a decoded sealed one through the LRU
+        with self._lock:
+            part = self._hot.get(day) or self._cache.get(day)
+            if part is not None:
+                if day in self._cache:
+                    self._cache.move_to_end(day)
+                return part
+        part = EventPartition.from_doc(self._read_partition(day))
+        with self._lock:
+            self._cache[day] = part
+            while len(self._cache) > EVENT_PARTITION_CACHE:
+                self._cache.popitem(last=False)
+        return part
+
+    # --- store interface ---
+    def append(self, record):
+        with self._lock:
+            day = event_day(event_ts(record))
+            part = self._hot.get(day)
+            if part is None:
+                if day in self._manifest:
+                    # Late event for a sealed day: reopen it; the next seal
+                    # rewrites the partition with the old and new rows. The
+                    # day stays in the manifest until then, so a manifest
+                    # written meanwhile can't drop the sealed rows.
+                    part = EventPartition.from_doc(self._read_partition(day))
+                    self._manifest[day]['absorbed'] = -1
+                    self._write_manifest()
+                    self._add_totals(self._manifest[day]['counts'], -1)
+                    self._add_totals(part.counts, 1)
+                    self._cache.pop(day, None)
+                else:
+                    part = EventPartition(day)
+                self._hot[day] = part
+                self._files[day] = open(self._file(day, 'jsonl'), 'a', encoding='utf-8')
+            self._files[day].write(json.dumps(record) + '\n')
+            self._dirty.add(day)
+            part.add(record)
+            ev_type = record.get('type') or 'unknown'
+            self._totals[ev_type] = self._totals.get(ev_type, 0) + 1
+            self._count += 1
+            self._notify(None, record)
+        return record
+
+    def put(self, record):
+        return self.append(record)
+
+    def get(self, record_id):
+        return next((e for e in self.scan() if e.get('id') == record_id), None)
+
+    def all(self):
+        return list(self.scan())
+
+    def count(self):
+        return self._count
+
+    def replace_all(self, records):
+        with self._lock:
+            for fh in self._files.values():
+                fh.close()
+            old = f'{self.path}.old'
+            self._build(f'{self.path}.new', records)
+            os.replace(self.path, old)
+            os.replace(f'{self.path}.new', self.path)
+            shutil.rmtree(old, ignore_errors=True)
+            self._hot, self._files, self._dirty = {}, {}, set()
+            self._cache.clear()
+            self._totals, self._count = {}, 0
+            self._load()
+            self._notify(None, None)
+
+    def sync(self):
+        with self._lock:
+            for day in self._dirty:
+                fh = self._files.get(day)
+                if fh:
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            self._dirty = set()
+
+    def seal(self, today=None):
+        # Convert hot partitions of past days to columnar files. Run it on the
+        # writer thread so no append races the rewrite.
+        today = today or event_day(int(time.time() * 1000))
+        with self._lock:
+            days = [d for d in self._hot if d < today]
+        for day in days:
+            with self._lock:
+                part = self._hot[day]
+                fh = self._files.pop(day)
+                fh.flush()
+                os.fsync(fh.fileno())
+                fh.close()
+                segment = self._file(day, 'jsonl')
+                absorbed = os.path.getsize(segment)
+                self._write_partition(self._file(day, 'evc'), part, absorbed)
+                self._manifest[day] = dict(part.meta(), absorbed=absorbed)
+                self._write_manifest()
+                os.remove(segment)
+                del self._hot[day]
+                self._dirty.discard(day)
+        return len(days)
+
+    # --- reads ---
+    def scan(self, since=None, until=None, types=None, order='asc', after=None):
+        # Events in (ts, id) order, optionally time-bounded [since, until),
+        # limited to a set of types and resumed after a cursor key. Partitions
+        # are pruned by day and type counts before any file is opened.
+        reverse = order == 'desc'
+        lo_day = event_day(since) if since is not None else None
+        hi_day = event_day(until - 1) if until is not None else None
+        if after is not None:
+            if reverse:
+                hi_day = min(hi_day or '9999', event_day(after[0]))
+            else:
+                lo_day = max(lo_day or '', event_day(after[0]))
+        with self._lock:
+            days = []
+            for day, meta in self._sealed() + list(self._hot.items()):
+                if (lo_day and day < lo_day) or (hi_day and day > hi_day):
+                    continue
+                counts = meta['counts'] if isinstance(meta, dict) else meta.counts
+                if types and not any(t in counts for t in types):
+                    continue
+                hot = self._hot.get(day)
+                days.append((day, hot, len(hot) if hot else 0, hot.sorted if hot else True))
+        days.sort(reverse=reverse)
+        for day, hot, n, is_sorted in days:
+            part = hot or self._partition(day)
+            if not hot:
+                n = len(part)
+            for i in part.positions(n, is_sorted, since, until, types, after, reverse):
+                yield part.row(i)
+
+    def summary(self, since=None, until=None):
+        # Type counts; partitions wholly inside the range use their stored counts
+        if since is None and until is None:
+            with self._lock:
+                return dict(self._totals)
+        lo = since if since is not None else float('-inf')
+        hi = until if until is not None else float('inf')
+        out = {}
+        with self._lock:
+            sources = [(d, m['min_ts'], m['max_ts'], m['counts']) for d, m in self._sealed()]
+            sources += [(d, p.min_ts, p.max_ts, dict(p.counts)) for d, p in self._hot.items() if len(p)]
+        for day, min_ts, max_ts, counts in sources:
+            if max_ts < lo or min_ts >= hi:
+                continue
+            if lo <= min_ts and max_ts < hi:
+                for t, n in counts.items():
+                    out[t] = out.get(t, 0) + n
+                continue
+            part = self._partition(day)
+            for i in part.positions(len(part), part.sorted, since, until, None, None, False):
+                t = part.types[part.type[i]]
+                out[t] = out.get(t, 0) + 1
+        return out
+
+# --- Order storage ---
+# Orders live in the reweave.db orders table: the full record in data_json and
+# the fields queries filter on as real columns, with a primary key on id and
+# indexes on (created_at, id) and (user_id, created_at DESC). Writes go
+# through the writer's connection and so commit in the same transaction as
+# the job (and its rollup updates); reads on the writer thread use that
+# connection too so a job sees the batch's earlier writes. Until schema v4 has
+# imported the legacy orders file, reads are served from that file.
+ORDER_LEGACY_FILES = [os.path.splitext(ORDERS_FILE)[0] + '.jsonl', ORDERS_FILE]
+
+def order_row(o):
+    try:
+        total = float(o.get('total') or 0)
+    except (TypeError, ValueError):
+        total = None
+    return (
+        o.get('id'),
+        o.get('user_id'),
+        total,
+        o.get('currency'),
+        o.get('status'),
+        int(o.get('created_at') or 0),
+        int(o.get('updated_at') or o.get('created_at') or 0),
+        json.dumps(o.get('items') or []),
+        json.dumps(o),
+    )
+
+ORDER_UPSERT = """
+    INSERT INTO orders (id, user_id, total, currency, status, created_at, updated_at, items_json, data_json)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        user_id = excluded.user_id, total = excluded.total, currency = excluded.currency,
+        status = excluded.status, created_at = excluded.created_at, updated_at = excluded.updated_at,
+        items_json = excluded.items_json, data_json = excluded.data_json
+"""
+
+class SqliteOrderStore(ObservableStore):
+    def __init__(self, legacy_paths=()):
+        self.legacy_paths = legacy_paths
+        self._ready = False
+
+    def _conn(self):
+        return WRITER.reader()
+
+    def ready(self):
+        # True once the orders table carries data_json (schema v4)
+        if not self._ready:
+            try:
+                cols = { r[1] for r in self._conn().execute("PRAGMA table_info(orders)") }
+            except sqlite3.Error:
+                cols = set()
+            self._ready = 'data_json' in cols
+        return self._ready
+
+    def _records(self, sql, params=()):
+        return [json.loads(r[0]) for r in self._conn().execute(sql, params)]
+
+    def all(self):
+        if not self.ready():
+            return read_legacy_records(self.legacy_paths)
+        return self._records("SELECT data_json FROM orders ORDER BY created_at, id")
+
+    def get(self, record_id):
+        if not self.ready():
+            return next((o for o in read_legacy_records(self.legacy_paths) if o.get('id') == record_id), None)
+        row = self._conn().execute("SELECT data_json FROM orders WHERE id = ?", (record_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self):
+        if not self.ready():
+            return len(read_legacy_records(self.legacy_paths))
+        return self._conn().execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def page(self, after=None, limit=100, reverse=False):
+        # Keyset page on (created_at, id); `after` is the id of the last row seen
+        direction = 'DESC' if reverse else 'ASC'
+        if after is None:
+            return self._records(f"SELECT data_json FROM orders ORDER BY created_at {direction}, id {direction} LIMIT ?", (limit,))
+        cmp = '<' if reverse else '>'
+        return self._records(f"""
+            SELECT o.data_json FROM orders o, (SELECT created_at, id FROM orders WHERE id = ?) a
+            WHERE (o.created_at, o.id) {cmp} (a.created_at, a.id)
+            ORDER BY o.created_at {direction}, o.id {direction} LIMIT ?
+        """, (after, limit))
+
+    def for_user(self, user_id, after=None, limit=-1):
+        # A customer's orders, newest first, from idx_orders_user_created
+        if after is None:
+            return self._records("""
+                SELECT data_json FROM orders WHERE user_id = ?
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            """, (user_id, limit))
+        return self._records("""
+            SELECT o.data_json FROM orders o, (SELECT created_at, id FROM orders WHERE id = ? AND user_id = ?) a
+            WHERE o.user_id = ? AND (o.created_at, o.id) < (a.created_at, a.id)
+            ORDER BY o.created_at DESC, o.id DESC LIMIT ?
+        """, (after, user_id, user_id, limit))
+
+    def in_status(self, status, updated_before=None, limit=-1):
+        # Oldest-updated first from idx_orders_status_updated
+        if updated_before is None:
+            return self._records("SELECT data_json FROM orders WHERE status = ? ORDER BY updated_at LIMIT ?",
+                                 (status, limit))
+        return self._records("""
+            SELECT data_json FROM orders WHERE status = ? AND updated_at < ?
+            ORDER BY updated_at LIMIT ?
+        """, (status, updated_before, limit))
+
+    def append(self, record):
+        old = self.get(record.get('id'))
+        WRITER.db().execute(ORDER_UPSERT, order_row(record))
+        self._notify(old, record)
+        return record
+
+    def put(self, record):
+        return self.append(record)
+
+    def replace_all(self, records):
+        conn = WRITER.db()
+        conn.execute("DELETE FROM orders")
+        conn.executemany(ORDER_UPSERT, [order_row(o) for o in records])
+        self._notify(None, None)
+
+    def sync(self):
+        # Committed with the writer's transaction
+        pass
+
+def open_store(legacy_path):
+    if STORAGE_ENGINE == 'json':
+        return JsonArrayStore(legacy_path)
+    return LogStore(os.path.splitext(legacy_path)[0] + '.jsonl', legacy_path)
+
+def open_event_store():
+    if STORAGE_ENGINE == 'json':
+        return JsonArrayStore(EVENTS_FILE)
+    return EventArchive(EVENTS_DIR, [os.path.splitext(EVENTS_FILE)[0] + '.jsonl', EVENTS_FILE])
+
+def open_order_store():
+    if STORAGE_ENGINE == 'json':
+        return JsonArrayStore(ORDERS_FILE)
+    return SqliteOrderStore(ORDER_LEGACY_FILES)
+
+LEADS_STORE = open_store(LEADS_FILE)
+EVENTS_STORE = open_event_store()
+ORDERS_STORE = open_order_store()
+USERS_STORE = JsonDocStore(USERS_FILE, unique=('email', 'reset_token'))
+SESSIONS_STORE = JsonDocStore(SESSIONS_FILE, primary='token')
+OTPS_STORE = JsonDocStore(OTPS_FILE, indent=None, primary=None)
+
+# --- Single writer with group commit ---
+# One thread owns every mutation. Handlers submit a job and block until the
+# batch containing it is fsynced/committed, so a response is only sent once
+# its write is durable and later reads see it (read-your-writes). Jobs that
+# arrive within REWEAVE_GROUP_COMMIT_MS of each other share one fsync and one
+# SQLite transaction.
+GROUP_COMMIT_MS = float(os.environ.get('REWEAVE_GROUP_COMMIT_MS', '2'))
+GROUP_COMMIT_MAX = int(os.environ.get('REWEAVE_GROUP_COMMIT_MAX', '512'))
+
+class WriteJob:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class Writer:
+    def __init__(self, stores, window_ms=GROUP_COMMIT_MS):
+        self.stores = stores
+        self.window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._conn = None
+        self._in_job = False
+        self._savepoint = False
+        self._aborted = None
+        self._after_commit = []
+        self._thread = threading.Thread(target=self._run, name='reweave-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        if threading.current_thread() is self._thread:
+            # Nested submit from inside a job joins the current batch
+            return fn(*args)
+        job = WriteJob(fn, args)
+        self._queue.put(job)
+        job.done.wait()
+        if job.error:
+            raise job.error
+        return job.result
+
+    def db(self):
+        # Writer-owned SQLite connection, only usable from inside a job. Each
+        # job runs under its own savepoint so a failing job rolls back alone.
+        if self._conn is None:
+            self._conn = open_db(isolation_level=None)
+        if not self._conn.in_transaction:
+            self._conn.execute('BEGIN')
+        if self._in_job and not self._savepoint:
+            self._conn.execute('SAVEPOINT job')
+            self._savepoint = True
+        return self._conn
+
+    def after_commit(self, fn):
+        # Run fn once the current batch is committed (once per batch), e.g. to
+        # invalidate a cache only when readers can see the new rows
+        if fn not in self._after_commit:
+            self._after_commit.append(fn)
+
+    def reader(self):
+        # Connection for reads: inside a job the writer's own, so the job
+        # sees its batch's uncommitted writes; elsewhere the thread's own
+        if threading.current_thread() is self._thread and self._in_job:
+            return self.db()
+        return db_conn()
+
+    def _apply(self, job):
+        self._in_job = True
+        self._savepoint = False
+        try:
+            job.result = job.fn(*job.args)
+        except Exception as e:
+            job.error = e
+        self._in_job = False
+        if self._savepoint:
+            self._savepoint = False
+            try:
+                if not self._conn.in_transaction:
+                    # SQLite already rolled the whole transaction back (disk
+                    # full, I/O error, out of memory), earlier jobs included
+                    raise sqlite3.OperationalError('transaction rolled back')
+                if job.error:
+                    self._conn.execute('ROLLBACK TO job')
+                self._conn.execute('RELEASE job')
+            except sqlite3.Error as e:
+                self._aborted = self._aborted or e
+
+    def _commit(self):
+        if self._conn is not None and self._conn.in_transaction:
+            self._conn.execute('COMMIT')
+        for store in self.stores:
+            store.sync()
+
+    def _rollback(self):
+        # Abandon the batch; a connection that can't even roll back is
+        # dropped and db() opens a fresh one for the next batch
+        if self._conn is None:
+            return
+        try:
+            if self._conn.in_transaction:
+                self._conn.execute('ROLLBACK')
+        except sqlite3.Error as e:
+            print('[writer] rollback failed:', e)
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < GROUP_COMMIT_MAX:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for job in batch:
+                    self._apply(job)
+                if self._aborted:
+                    raise self._aborted
+                self._commit()
+            except Exception as e:
+                print('[writer] commit failed:', e)
+                self._rollback()
+                for job in batch:
+                    job.error = job.error or e
+            finally:
+                self._aborted = None
+                callbacks, self._after_commit = self._after_commit, []
+                for fn in callbacks:
+                    try:
+                        fn()
+                    except Exception as e:
+                        print('[writer] after-commit callback failed:', e)
+                # Waiters are always released, whatever happened above
+                for job in batch:
+                    job.done.set()
+
+WRITER = Writer([LEADS_STORE, EVENTS_STORE, ORDERS_STORE, USERS_STORE, SESSIONS_STORE, OTPS_STORE])
+
+def update_record(store, record_id, mutate):
+    # Read-modify-write of a single record on the writer thread; returns the
+    # updated record, or None when the id is unknown
+    def job():
+        current = store.get(record_id)
+        if not current:
+            return None
+        record = copy.deepcopy(current)
+        mutate(record)
+        store.put(record)
+        return record
+    return WRITER.submit(job)
+
+def read_leads():
+    return LEADS_STORE.all()
 
 def write_leads(leads):
-    with open(LEADS_FILE, 'w') as f:
-        json.dump(leads, f, indent=2)
+    WRITER.submit(LEADS_STORE.replace_all, leads)
 
 def read_events():
-    try:
-        with open(EVENTS_FILE, 'r') as f:
-            return json.load(f)
-    except Exception:
-        return []
+    return EVENTS_STORE.all()
 
 def write_events(events):
-    with open(EVENTS_FILE, 'w') as f:
-        json.dump(events, f, indent=2)
-
-def read_orders():
+    WRITER.submit(EVENTS_STORE.replace_all, events)
+
+def scan_events(since=None, until=None, types=None, order='asc', after=None):
+    # Filtered events in (ts, id) order; the archive prunes partitions, the
+    # JSON engine filters its full list
+    if isinstance(EVENTS_STORE, EventArchive):
+        return EVENTS_STORE.scan(since, until, types, order, after)
+    reverse = order == 'desc'
+    rows = sorted(EVENTS_STORE.all(), key=event_key, reverse=reverse)
+    return (e for e in rows
+            if (since is None or event_ts(e) >= since) and (until is None or event_ts(e) < until)
+            and (not types or e.get('type') in types)
+            and (after is None or ((event_key(e) < after) if reverse else (event_key(e) > after))))
+
+def event_summary(since=None, until=None):
+    if isinstance(EVENTS_STORE, EventArchive):
+        return EVENTS_STORE.summary(since, until)
+    summary = {}
+    for e in scan_events(since, until):
+        t = e.get('type', 'unknown')
+        summary[t] = summary.get(t, 0) + 1
+    return summary
+
+def encode_cursor(key):
+    # Opaque resume token for keyset pagination
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
     try:
-        with open(ORDERS_FILE, 'r') as f:
-            return json.load(f)
+        key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
     except Exception:
-        return []
+        raise ValueError('invalid cursor')
+    # Cursors are [id] or [ts, id]; anything else (nested lists, objects)
+    # would reach the store lookups as an unhashable or mistyped key
+    if not isinstance(key, list) or not 1 <= len(key) <= 2:
+        raise ValueError('invalid cursor')
+    for part in key:
+        if part is not None and (isinstance(part, bool) or not isinstance(part, (str, int))):
+            raise ValueError('invalid cursor')
+    return tuple(key)
+
+# --- List pagination ---
+# List endpoints take ?limit=&cursor= (keyset: the cursor names the last row
+# returned, so pages stay stable while new rows are written), ?order=desc and
+# ?fields=a,b,c to project each row onto the given top-level fields. Paged
+# responses carry next_cursor (null on the last page). Without limit/cursor
+# the whole collection is returned as before.
+PAGE_DEFAULT = 100
+PAGE_MAX = 1000
+
+def page_params(qs):
+    # -> (paged, limit, after key or None, fields or None, reverse); ValueError on bad input
+    paged = 'limit' in qs or 'cursor' in qs
+    limit = int(qs['limit'][0]) if qs.get('limit') else PAGE_DEFAULT
+    if limit < 1:
+        raise ValueError('invalid limit')
+    after = decode_cursor(qs['cursor'][0]) if qs.get('cursor') else None
+    fields = [f for v in qs.get('fields', []) for f in v.split(',') if f] or None
+    reverse = (qs.get('order') or [''])[0] == 'desc'
+    return paged, min(limit, PAGE_MAX), after, fields, reverse
+
+def project(records, fields):
+    if not fields:
+        return records
+    return [{ f: r[f] for f in fields if f in r } for r in records]
+
+def page_of(rows, limit, key):
+    # First `limit` of an iterable plus the cursor for the next page
+    rows = list(itertools.islice(rows, limit + 1))
+    next_cursor = encode_cursor(key(rows[limit - 1])) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def store_page(store, after, limit, reverse):
+    # Keyset page over a record store ordered by write order, cursor = [id]
+    rows = store.page(after[0] if after else None, limit + 1, reverse)
+    next_cursor = encode_cursor([rows[limit - 1].get('id')]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def list_response(handler, name, rows, fields, next_cursor=None, paged=False):
+    payload = { 'ok': True, 'count': len(rows), name: project(rows, fields) }
+    if paged:
+        payload['next_cursor'] = next_cursor
+    return json_response(handler, payload)
+
+def read_orders():
+    return ORDERS_STORE.all()
+
+def orders_in_status(status, updated_before=None, limit=-1):
+    if isinstance(ORDERS_STORE, SqliteOrderStore) and ORDERS_STORE.ready():
+        return ORDERS_STORE.in_status(status, updated_before, limit)
+    orders = sorted((o for o in ORDERS_STORE.all() if o.get('status') == status
+                     and (updated_before is None or (o.get('updated_at') or 0) < updated_before)),
+                    key=lambda o: o.get('updated_at') or 0)
+    return orders if limit < 0 else orders[:limit]
+
+def orders_for_user(user_id, after=None, limit=-1):
+    # Newest first; indexed on the SQLite store, a filtered scan on the JSON one
+    if isinstance(ORDERS_STORE, SqliteOrderStore) and ORDERS_STORE.ready():
+        return ORDERS_STORE.for_user(user_id, after, limit)
+    orders = sorted((o for o in ORDERS_STORE.all() if o.get('user_id') == user_id),
+                    key=lambda o: (o.get('created_at') or 0, o.get('id') or ''), reverse=True)
+    if after is not None:
+        ids = [o.get('id') for o in orders]
+        orders = orders[ids.index(after) + 1:] if after in ids else []
+    return orders if limit < 0 else orders[:limit]
 
 def write_orders(orders):
-    with open(ORDERS_FILE, 'w') as f:
-        json.dump(orders, f, indent=2)
+    WRITER.submit(ORDERS_STORE.replace_all, orders)
 
 def read_products_file():
     try:
@@ -68,11 +1265,35 @@ def read_products_file():
 def write_products(products):
     with open(PRODUCTS_FILE, 'w') as f:
         json.dump(products, f, indent=2)
+    CATALOG.invalidate()
 
 # --- SQLite helpers and bootstrap ---
-def db_conn():
-    conn = sqlite3.connect(DB_PATH)
+# Connections are opened once per thread and kept for its lifetime, so request
+# workers reuse both the connection and its prepared-statement cache. WAL lets
+# readers run alongside the writer thread's transactions.
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    f"PRAGMA synchronous={os.environ.get('REWEAVE_SQLITE_SYNCHRONOUS', 'NORMAL')}",
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=134217728',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+SQLITE_STATEMENT_CACHE = 256
+_DB_LOCAL = threading.local()
+
+def open_db(**kwargs):
+    conn = sqlite3.connect(DB_PATH, cached_statements=SQLITE_STATEMENT_CACHE, **kwargs)
     conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def db_conn():
+    # Thread-local persistent connection; callers must not close it
+    conn = getattr(_DB_LOCAL, 'conn', None)
+    if conn is None:
+        conn = _DB_LOCAL.conn = open_db()
     return conn
 
 def init_db():
@@ -159,16 +1380,139 @@ def init_db():
         )
     """)
     conn.commit()
-    conn.close()
+    migrate_db(conn)
+
+# --- Schema migrations ---
+# Each step upgrades reweave.db by one version and PRAGMA user_version records
+# the last one applied, so init_db() brings any older database up to date.
+# Append new steps; never edit one that has shipped.
+def product_columns(p):
+    return (
+        p.get('title') or p.get('name') or '',
+        p.get('description') or '',
+        p.get('category') or '',
+        json.dumps(p.get('images') or []),
+    )
+
+def migration_product_columns(cur):
+    # Real columns for the fields detail/inventory reads select
+    existing = { r[1] for r in cur.execute("PRAGMA table_info(products)") }
+    for col in ('title', 'description', 'category', 'images_json'):
+        if col not in existing:
+            cur.execute(f"ALTER TABLE products ADD COLUMN {col} TEXT")
+    for pid, data_json in cur.execute("SELECT id, data_json FROM products").fetchall():
+        cur.execute(
+            "UPDATE products SET title = ?, description = ?, category = ?, images_json = ? WHERE id = ?",
+            product_columns(json.loads(data_json or '{}')) + (pid,)
+        )
+
+def migration_variant_indexes(cur):
+    # Covering indexes: per-product variant lists (and the catalog loader's
+    # ORDER BY product_id) and sku lookups are answered from the index alone
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_variants_product ON variants(product_id, sku, price, stock, options_json)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_variants_sku ON variants(sku, product_id, price, stock, options_json)")
+
+def migration_rollups(cur):
+    # Revenue/product rollups per hour, day and month, backfilled from the
+    # order history on creation
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS revenue_rollups (
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            revenue_sen INTEGER NOT NULL DEFAULT 0,
+            orders INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS product_rollups (
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            product_id TEXT NOT NULL,
+            units INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket, product_id)
+        ) WITHOUT ROWID
+    """)
+    backfill_rollups(cur, ORDERS_STORE.all())
+
+def migration_order_storage(cur):
+    # Orders move from the record log into the orders table
+    existing = { r[1] for r in cur.execute("PRAGMA table_info(orders)") }
+    if 'data_json' not in existing:
+        cur.execute("ALTER TABLE orders ADD COLUMN data_json TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at DESC, id DESC)")
+    if cur.execute("SELECT 1 FROM orders WHERE data_json IS NOT NULL LIMIT 1").fetchone() is None:
+        cur.executemany(ORDER_UPSERT, [order_row(o) for o in read_legacy_records(ORDER_LEGACY_FILES)])
+
+def migration_fpx_inbox(cur):
+    # Durable FPX webhook deliveries, deduplicated by idempotency key
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS fpx_inbox (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT NOT NULL UNIQUE,
+            order_id TEXT,
+            status TEXT,
+            payload_json TEXT,
+            received_at INTEGER NOT NULL,
+            processed_at INTEGER,
+            result TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fpx_inbox_pending ON fpx_inbox(seq) WHERE processed_at IS NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fpx_inbox_processed ON fpx_inbox(processed_at) WHERE processed_at IS NOT NULL")
+
+def migration_order_status_index(cur):
+    # Per-status queues ordered by last change, for the pending reconciler
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_updated ON orders(status, updated_at)")
+
+def migration_stock_reservations(cur):
+    # Variant option labels, to price cart lines that name a variant by its
+    # label, and the stock each order holds
+    existing = { r[1] for r in cur.execute("PRAGMA table_info(variants)") }
+    if 'option_label' not in existing:
+        cur.execute("ALTER TABLE variants ADD COLUMN option_label TEXT")
+    for (data_json,) in cur.execute("SELECT data_json FROM products").fetchall():
+        for v in json.loads(data_json or '{}').get('variants') or []:
+            if v.get('sku') and v.get('option'):
+                cur.execute("UPDATE variants SET option_label = ? WHERE sku = ?", (v['option'], v['sku']))
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            order_id TEXT NOT NULL,
+            sku TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            released_at INTEGER,
+            PRIMARY KEY (order_id, sku)
+        ) WITHOUT ROWID
+    """)
+
+MIGRATIONS = [
+    migration_product_columns,
+    migration_variant_indexes,
+    migration_rollups,
+    migration_order_storage,
+    migration_fpx_inbox,
+    migration_order_status_index,
+    migration_stock_reservations,
+]
+
+def migrate_db(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.execute("BEGIN")
+            step(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f'[db-migrate] schema at version {target}')
 
 def db_has_products():
     try:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(1) AS c FROM products")
-        c = cur.fetchone()
-        conn.close()
-        return (c and int(c[0]) > 0)
+        return db_conn().execute("SELECT 1 FROM products LIMIT 1").fetchone() is not None
     except Exception:
         return False
 
@@ -182,7 +1526,10 @@ def seed_products_from_json_to_db():
         pid = p.get('id')
         if not pid:
             continue
-        cur.execute("INSERT OR REPLACE INTO products (id, data_json) VALUES (?,?)", (pid, json.dumps(p)))
+        cur.execute(
+            "INSERT OR REPLACE INTO products (id, data_json, title, description, category, images_json) VALUES (?,?,?,?,?,?)",
+            (pid, json.dumps(p)) + product_columns(p)
+        )
         for v in (p.get('variants') or []):
             sku = v.get('sku')
             if not sku:
@@ -191,46 +1538,74 @@ def seed_products_from_json_to_db():
             stock = int(v.get('stock') or 0)
             options_json = json.dumps(v.get('options') or {})
             cur.execute(
-                "INSERT OR REPLACE INTO variants (sku, product_id, price, stock, options_json) VALUES (?,?,?,?,?)",
-                (sku, pid, price, stock, options_json)
+                "INSERT OR REPLACE INTO variants (sku, product_id, price, stock, options_json, option_label) VALUES (?,?,?,?,?,?)",
+                (sku, pid, price, stock, options_json, v.get('option'))
             )
     conn.commit()
-    conn.close()
+    CATALOG.invalidate()
 
 def get_products_from_db():
     try:
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT id, data_json FROM products")
-        rows = cur.fetchall()
+        cur = db_conn().cursor()
         prod_map = {}
-        for r in rows:
+        for r in cur.execute("SELECT id, data_json FROM products"):
             data = json.loads(r['data_json'])
+            data['variants'] = data.get('variants') or []
             prod_map[r['id']] = data
-        # attach variants
-        cur.execute("SELECT sku, product_id, price, stock, options_json FROM variants")
-        for r in cur.fetchall():
-            p = prod_map.get(r['product_id'])
-            if not p:
+        # Attach variants in one pass ordered by product: a sku -> variant dict
+        # for the current product keeps each row O(1). DB rows carry the live
+        # price/stock, so they update a variant already in data_json and are
+        # appended otherwise (sku stays unique). Option combos repeat across
+        # variants, so each distinct options_json is parsed once.
+        current_id = None
+        product = None
+        by_sku = None
+        parsed_options = {}
+        for sku, product_id, price, stock, options_json in cur.execute(
+                "SELECT sku, product_id, price, stock, options_json FROM variants ORDER BY product_id"):
+            if product_id != current_id:
+                current_id = product_id
+                product = prod_map.get(product_id)
+                by_sku = { v.get('sku'): v for v in product['variants'] } if product else None
+            if product is None:
                 continue
-            vs = p.get('variants') or []
-            # Replace variants with DB values (ensuring sku uniqueness)
-            # Build variant object similar to file schema
-            variant = {
-                'sku': r['sku'],
-                'price': r['price'],
-                'stock': r['stock'],
-                'options': json.loads(r['options_json'] or '{}')
-            }
-            # Avoid duplicates if already present
-            if not any((v.get('sku') == variant['sku']) for v in vs):
-                vs.append(variant)
-            p['variants'] = vs
-        conn.close()
+            options = parsed_options.get(options_json)
+            if options is None:
+                options = parsed_options[options_json] = json.loads(options_json or '{}')
+            merge_variant_row(product, by_sku, sku, price, stock, options)
         return list(prod_map.values())
     except Exception:
         return []
 
+def merge_variant_row(product, by_sku, sku, price, stock, options, label=None):
+    variant = by_sku.get(sku)
+    if variant is None:
+        variant = { 'sku': sku, 'price': price, 'stock': stock, 'options': dict(options) }
+        if label:
+            variant['option'] = label
+        product['variants'].append(variant)
+        by_sku[sku] = variant
+        return
+    variant['price'] = price
+    variant['stock'] = stock
+    if options:
+        variant['options'] = dict(options)
+
+def get_product_from_db(product_id):
+    # One product shaped like get_products_from_db's (the stored record with
+    # live variant price/stock merged in), or None
+    conn = db_conn()
+    row = conn.execute("SELECT data_json FROM products WHERE id = ?", (product_id,)).fetchone()
+    if row is None:
+        return None
+    product = json.loads(row['data_json'])
+    product['variants'] = product.get('variants') or []
+    by_sku = { v.get('sku'): v for v in product['variants'] }
+    for sku, price, stock, options_json, label in conn.execute(
+            "SELECT sku, price, stock, options_json, option_label FROM variants WHERE product_id = ?", (product_id,)):
+        merge_variant_row(product, by_sku, sku, price, stock, json.loads(options_json or '{}'), label)
+    return product
+
 def read_products():
     # Prefer DB, fallback to file
     if db_has_products():
@@ -239,132 +1614,767 @@ def read_products():
             return prods
     return read_products_file()
 
+# --- Catalog snapshot ---
+# GET /api/products serves a snapshot built once from read_products() and kept
+# as encoded (and gzipped) bytes. Anything that changes products or variants
+# must call CATALOG.invalidate(); the next request rebuilds it. The ETag is a
+# hash of the body, so it survives restarts and clients revalidate with
+# If-None-Match for a 304.
+CATALOG_GZIP = os.environ.get('REWEAVE_CATALOG_GZIP', '1') != '0'
+
+class CatalogSnapshot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.version = 0
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._snapshot = None
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                version = self.version
+                products = read_products()
+                body = json.dumps({ 'ok': True, 'products': products }).encode('utf-8')
+                self._snapshot = {
+                    'version': version,
+                    'products': products,
+                    'positions': { p.get('id'): i for i, p in enumerate(products) },
+                    'etag': '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+                    'body': body,
+                    'gzip': gzip.compress(body, 6) if CATALOG_GZIP else None,
+                }
+            return self._snapshot
+
+CATALOG = CatalogSnapshot()
+
+def catalog_response(handler):
+    snap = CATALOG.get()
+    headers = { 'ETag': snap['etag'], 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding' }
+    inm = handler.headers.get('If-None-Match', '')
+    if inm and (inm.strip() == '*' or snap['etag'] in [t.strip() for t in inm.split(',')]):
+        handler.send_response(304)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        set_cors(handler)
+        handler.end_headers()
+        return
+    if snap['gzip'] is not None and 'gzip' in handler.headers.get('Accept-Encoding', '').lower():
+        headers['Content-Encoding'] = 'gzip'
+        return bytes_response(handler, snap['gzip'], 200, 'application/json', headers)
+    return bytes_response(handler, snap['body'], 200, 'application/json', headers)
+
 def read_users():
-    try:
-        with open(USERS_FILE, 'r') as f:
-            return json.load(f)
-    except Exception:
-        return []
+    return USERS_STORE.all()
 
 def read_otps():
-    try:
-        with open(OTPS_FILE, 'r') as f:
-            return json.load(f)
-    except Exception:
-        return []
+    return OTPS_STORE.all()
 
 def write_otps(otps):
     try:
-        with open(OTPS_FILE, 'w') as f:
-            json.dump(otps, f)
+        WRITER.submit(OTPS_STORE.replace_all, otps)
     except Exception:
         pass
 
 def write_users(users):
-    with open(USERS_FILE, 'w') as f:
-        json.dump(users, f, indent=2)
+    WRITER.submit(USERS_STORE.replace_all, users)
 
 def read_sessions():
-    try:
-        with open(SESSIONS_FILE, 'r') as f:
-            return json.load(f)
-    except Exception:
-        return []
+    return SESSIONS_STORE.all()
 
 def write_sessions(sessions):
-    with open(SESSIONS_FILE, 'w') as f:
-        json.dump(sessions, f, indent=2)
+    WRITER.submit(SESSIONS_STORE.replace_all, sessions)
+
+def consume_otp(predicate):
+    # Find and delete a matching OTP/magic token in one writer job, so a code
+    # can only ever be redeemed once
+    def job():
+        match = next((o for o in OTPS_STORE.all() if predicate(o)), None)
+        if match:
+            OTPS_STORE.remove(lambda o: o is match)
+        return match
+    return WRITER.submit(job)
+
+def issue_otp(otp):
+    # Replace any outstanding OTP of the same type for this email
+    def job():
+        OTPS_STORE.remove(lambda o: o.get('type') == otp['type'] and o.get('email') == otp['email'])
+        OTPS_STORE.append(otp)
+    WRITER.submit(job)
+
+# --- Analytics metrics ---
+# Dashboard KPIs are materialized: the engine observes the orders, leads,
+# events and users stores and applies each change as a delta (remove the old
+# record's contribution, add the new one), so reading the metrics costs
+# O(days shown + products) instead of a scan of the whole history. Money is
+# summed in integer sen so repeated add/remove cycles cannot drift. A store
+# replaced wholesale triggers a rebuild of that part; rebuild() recomputes
+# everything from the stores and doubles as a consistency check.
+PENDING_STATUSES = ('pending_payment', 'payment_pending', 'payment_initiated')
+METRICS_CHECK_INTERVAL = int(os.environ.get('REWEAVE_METRICS_CHECK_INTERVAL', '3600'))
+
+def to_sen(amount):
+    try:
+        return int(round(float(amount or 0) * 100))
+    except (TypeError, ValueError):
+        return 0
 
-def compute_analytics_metrics():
-    # Aggregate business KPIs across orders, leads, events, users
-    events = read_events()
-    leads = read_leads()
-    orders = read_orders()
-    users = read_users()
-
-    # Basic counts
-    total_orders = len(orders)
-    paid_orders = [o for o in orders if (o.get('status') or '') == 'paid']
-    pending_orders = [o for o in orders if (o.get('status') or '') in ('pending_payment','payment_pending','payment_initiated')]
-    failed_orders = [o for o in orders if (o.get('status') or '') == 'payment_failed']
-
-    revenue_total = sum(float(o.get('total') or 0) for o in paid_orders)
-    aov = (revenue_total / len(paid_orders)) if paid_orders else 0
-    leads_count = len(leads)
-    events_count = len(events)
-
-    # Wishlist totals
-    wishlist_items_total = 0
-    wishlist_users = 0
-    for u in users:
-        wl = u.get('wishlist', []) or []
-        wishlist_items_total += len(wl)
-        if len(wl) > 0:
-            wishlist_users += 1
-
-    # Simple conversion estimate: paid orders / leads
-    conversion_rate = (len(paid_orders) / leads_count) if leads_count > 0 else 0
-
-    # Last 7 days revenue trend (UTC day buckets)
+def order_day(order):
+    ts = order.get('created_at') or order.get('updated_at') or 0
     try:
-        dtmod = __import__('datetime')
-        now = dtmod.datetime.utcnow()
-        day_fmt = '%Y-%m-%d'
-        last7 = [(now - dtmod.timedelta(days=i)).strftime(day_fmt) for i in range(6, -1, -1)]
-    except Exception:
-        last7 = []
-    revenue_by_day = { d: 0 for d in last7 }
-    orders_by_day = { d: 0 for d in last7 }
-    for o in paid_orders:
-        ts = o.get('created_at') or o.get('updated_at') or 0
-        try:
-            dt = __import__('datetime').datetime.utcfromtimestamp(int(ts)/1000)
-            dkey = dt.strftime('%Y-%m-%d')
-        except Exception:
-            dkey = None
-        if dkey in revenue_by_day:
-            revenue_by_day[dkey] += float(o.get('total') or 0)
-            orders_by_day[dkey] += 1
-
-    # Top products by frequency in paid orders
-    top_products = {}
-    for o in paid_orders:
-        for it in (o.get('items') or []):
+        return time.strftime('%Y-%m-%d', time.gmtime(int(ts) / 1000))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+class MetricsEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset_orders()
+        self.leads = 0
+        self.events = 0
+        self.wishlist_items = 0
+        self.wishlist_users = 0
+
+    def _reset_orders(self):
+        self.orders = 0
+        self.by_status = {}
+        self.revenue_sen = 0
+        self.paid_by_day = {}
+        self.products = {}
+        self._top = None
+
+    @staticmethod
+    def _bump(counter, key, delta):
+        value = counter.get(key, 0) + delta
+        if value:
+            counter[key] = value
+        else:
+            counter.pop(key, None)
+
+    def _apply_order(self, order, sign):
+        status = order.get('status') or ''
+        self.orders += sign
+        self._bump(self.by_status, status, sign)
+        if status != 'paid':
+            return
+        sen = to_sen(order.get('total'))
+        self.revenue_sen += sign * sen
+        day = order_day(order)
+        if day:
+            bucket = self.paid_by_day.setdefault(day, [0, 0])
+            bucket[0] += sign * sen
+            bucket[1] += sign
+            if bucket == [0, 0]:
+                del self.paid_by_day[day]
+        for it in (order.get('items') or []):
             pid = it.get('id') or it.get('productId') or 'unknown'
-            top_products[pid] = top_products.get(pid, 0) + 1
-    # Sort top products
-    top_products_sorted = sorted([{ 'productId': k, 'count': v } for k, v in top_products.items()], key=lambda x: x['count'], reverse=True)
+            self._bump(self.products, pid, sign)
+        self._top = None
+
+    def _apply_user(self, user, sign):
+        n = len(user.get('wishlist') or [])
+        self.wishlist_items += sign * n
+        if n:
+            self.wishlist_users += sign
+
+    def _changed(self, old, new, apply):
+        if old is not None:
+            apply(old, -1)
+        if new is not None:
+            apply(new, 1)
+
+    # Store observers; they run on the writer thread under the store lock
+    def on_order(self, old, new):
+        with self._lock:
+            if old is None and new is None:
+                self._rebuild_orders(ORDERS_STORE.all())
+            else:
+                self._changed(old, new, self._apply_order)
+
+    def on_user(self, old, new):
+        with self._lock:
+            if old is None and new is None:
+                self._rebuild_users(USERS_STORE.all())
+            else:
+                self._changed(old, new, self._apply_user)
+
+    def on_lead(self, old, new):
+        with self._lock:
+            if old is None and new is None:
+                self.leads = LEADS_STORE.count()
+            else:
+                self.leads += (new is not None) - (old is not None)
+
+    def on_event(self, old, new):
+        with self._lock:
+            if old is None and new is None:
+                self.events = EVENTS_STORE.count()
+            else:
+                self.events += (new is not None) - (old is not None)
+
+    def _rebuild_orders(self, orders):
+        self._reset_orders()
+        for o in orders:
+            self._apply_order(o, 1)
+
+    def _rebuild_users(self, users):
+        self.wishlist_items = 0
+        self.wishlist_users = 0
+        for u in users:
+            self._apply_user(u, 1)
+
+    def rebuild(self):
+        # Full recomputation from the stores. Run it on the writer thread
+        # (WRITER.submit(METRICS.rebuild)) so no write lands halfway through.
+        # Returns whether the incrementally maintained state already matched.
+        with self._lock:
+            before = self.snapshot_state()
+            self._rebuild_orders(ORDERS_STORE.all())
+            self._rebuild_users(USERS_STORE.all())
+            self.leads = LEADS_STORE.count()
+            self.events = EVENTS_STORE.count()
+            return before == self.snapshot_state()
+
+    def snapshot_state(self):
+        return (self.orders, dict(self.by_status), self.revenue_sen,
+                { d: list(b) for d, b in self.paid_by_day.items() }, dict(self.products),
+                self.leads, self.events, self.wishlist_items, self.wishlist_users)
+
+    def metrics(self):
+        # Same shape as the original full-scan implementation
+        today = time.time()
+        last7 = [time.strftime('%Y-%m-%d', time.gmtime(today - 86400 * i)) for i in range(6, -1, -1)]
+        with self._lock:
+            paid = self.by_status.get('paid', 0)
+            pending = sum(self.by_status.get(s, 0) for s in PENDING_STATUSES)
+            revenue_total = self.revenue_sen / 100
+            days = { d: self.paid_by_day.get(d, [0, 0]) for d in last7 }
+            if self._top is None:
+                self._top = sorted(({ 'productId': k, 'count': v } for k, v in self.products.items()),
+                                   key=lambda x: x['count'], reverse=True)
+            return {
+                'orders': {
+                    'total': self.orders,
+                    'paid': paid,
+                    'pending': pending,
+                    'failed': self.by_status.get('payment_failed', 0),
+                    'expired': self.by_status.get('expired', 0),
+                },
+                'revenue': {
+                    'total': revenue_total,
+                    'currency': 'MYR',
+                    'aov': (revenue_total / paid) if paid else 0,
+                    'last7days': { d: b[0] / 100 for d, b in days.items() },
+                    'orders_last7days': { d: b[1] for d, b in days.items() },
+                },
+                'leads': {
+                    'total': self.leads
+                },
+                'events': {
+                    'total': self.events
+                },
+                'wishlist': {
+                    'items_total': self.wishlist_items,
+                    'users_with_wishlist': self.wishlist_users
+                },
+                'conversion': {
+                    'paid_over_leads': (paid / self.leads) if self.leads > 0 else 0
+                },
+                'top_products': list(self._top)
+            }
 
+METRICS = MetricsEngine()
+METRICS.rebuild()
+ORDERS_STORE.observe(METRICS.on_order)
+USERS_STORE.observe(METRICS.on_user)
+LEADS_STORE.observe(METRICS.on_lead)
+EVENTS_STORE.observe(METRICS.on_event)
+
+def compute_analytics_metrics():
+    return METRICS.metrics()
+
+def check_metrics():
+    if not WRITER.submit(METRICS.rebuild):
+        print('[metrics] incremental aggregates drifted from the stores; rebuilt')
+
+# --- Revenue rollups ---
+# Paid orders are pre-aggregated into revenue_rollups / product_rollups at
+# hour, day and month granularity (UTC buckets as sortable strings such as
+# '2025-11-17T09', '2025-11-17', '2025-11'). An orders-store observer applies
+# each status/total change as a delta inside the writer's transaction, so the
+# rollups commit together with the order. Range queries read at most one row
+# per bucket instead of scanning orders.
+ROLLUP_FORMATS = {
+    'hour': '%Y-%m-%dT%H',
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+}
+
+def rollup_buckets(ts_ms):
+    t = time.gmtime(int(ts_ms) / 1000)
+    return { g: time.strftime(fmt, t) for g, fmt in ROLLUP_FORMATS.items() }
+
+def order_units(order):
+    # product id -> units for one order
+    units = {}
+    for it in (order.get('items') or []):
+        pid = it.get('id') or it.get('productId') or 'unknown'
+        try:
+            qty = int(it.get('quantity') or it.get('qty') or 1)
+        except (TypeError, ValueError):
+            qty = 1
+        units[pid] = units.get(pid, 0) + qty
+    return units
+
+def rollup_contribution(order, sign, revenue, products):
+    # Adds sign * the order's contribution to the (granularity, bucket) dicts
+    if (order.get('status') or '') != 'paid':
+        return
+    ts = order.get('created_at') or order.get('updated_at')
+    try:
+        buckets = rollup_buckets(ts)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return
+    sen = to_sen(order.get('total'))
+    units = order_units(order)
+    for g, b in buckets.items():
+        acc = revenue.setdefault((g, b), [0, 0])
+        acc[0] += sign * sen
+        acc[1] += sign
+        for pid, n in units.items():
+            products[(g, b, pid)] = products.get((g, b, pid), 0) + sign * n
+
+def write_rollup_deltas(cur, revenue, products):
+    revenue_rows = [(g, b, sen, n) for (g, b), (sen, n) in revenue.items() if sen or n]
+    product_rows = [(g, b, pid, n) for (g, b, pid), n in products.items() if n]
+    cur.executemany("""
+        INSERT INTO revenue_rollups (granularity, bucket, revenue_sen, orders) VALUES (?, ?, ?, ?)
+        ON CONFLICT (granularity, bucket) DO UPDATE SET
+            revenue_sen = revenue_sen + excluded.revenue_sen,
+            orders = orders + excluded.orders
+    """, revenue_rows)
+    cur.executemany("""
+        INSERT INTO product_rollups (granularity, bucket, product_id, units) VALUES (?, ?, ?, ?)
+        ON CONFLICT (granularity, bucket, product_id) DO UPDATE SET units = units + excluded.units
+    """, product_rows)
+    if any(r[3] < 0 for r in revenue_rows) or any(r[3] < 0 for r in product_rows):
+        cur.execute("DELETE FROM revenue_rollups WHERE orders = 0 AND revenue_sen = 0")
+        cur.execute("DELETE FROM product_rollups WHERE units = 0")
+
+def backfill_rollups(cur, orders):
+    # Rebuild both tables from scratch; returns the number of paid orders
+    revenue, products = {}, {}
+    paid = 0
+    for o in orders:
+        if (o.get('status') or '') == 'paid':
+            paid += 1
+        rollup_contribution(o, 1, revenue, products)
+    cur.execute("DELETE FROM revenue_rollups")
+    cur.execute("DELETE FROM product_rollups")
+    write_rollup_deltas(cur, revenue, products)
+    return paid
+
+def on_order_rollup(old, new):
+    # Orders-store observer; runs on the writer thread inside the write's job
+    try:
+        cur = WRITER.db().cursor()
+        if old is None and new is None:
+            backfill_rollups(cur, ORDERS_STORE.all())
+            return
+        revenue, products = {}, {}
+        if old is not None:
+            rollup_contribution(old, -1, revenue, products)
+        if new is not None:
+            rollup_contribution(new, 1, revenue, products)
+        if revenue:
+            write_rollup_deltas(cur, revenue, products)
+    except sqlite3.Error as e:
+        print('[rollups] update failed, run --backfill-rollups:', e)
+
+ORDERS_STORE.observe(on_order_rollup)
+
+def query_rollups(since_ms, until_ms, granularity='day', top=10):
+    # Buckets overlapping [since, until); the first and last bucket are whole
+    # buckets, not clipped to the exact timestamps
+    first = rollup_buckets(since_ms)[granularity]
+    last = rollup_buckets(max(since_ms, until_ms - 1))[granularity]
+    conn = db_conn()
+    rows = conn.execute("""
+        SELECT bucket, revenue_sen, orders FROM revenue_rollups
+        WHERE granularity = ? AND bucket BETWEEN ? AND ? ORDER BY bucket
+    """, (granularity, first, last)).fetchall()
+    products = conn.execute("""
+        SELECT product_id, SUM(units) AS units FROM product_rollups
+        WHERE granularity = ? AND bucket BETWEEN ? AND ?
+        GROUP BY product_id ORDER BY units DESC, product_id LIMIT ?
+    """, (granularity, first, last, top)).fetchall()
+    series = []
+    revenue_sen = orders = 0
+    for r in rows:
+        revenue_sen += r['revenue_sen']
+        orders += r['orders']
+        series.append({
+            'bucket': r['bucket'],
+            'revenue': r['revenue_sen'] / 100,
+            'orders': r['orders'],
+            'aov': (r['revenue_sen'] / 100 / r['orders']) if r['orders'] else 0,
+        })
     return {
-        'orders': {
-            'total': total_orders,
-            'paid': len(paid_orders),
-            'pending': len(pending_orders),
-            'failed': len(failed_orders),
-        },
-        'revenue': {
-            'total': revenue_total,
-            'currency': 'MYR',
-            'aov': aov,
-            'last7days': revenue_by_day,
-            'orders_last7days': orders_by_day,
-        },
-        'leads': {
-            'total': leads_count
-        },
-        'events': {
-            'total': events_count
+        'from': since_ms,
+        'to': until_ms,
+        'granularity': granularity,
+        'currency': 'MYR',
+        'totals': {
+            'revenue': revenue_sen / 100,
+            'orders': orders,
+            'aov': (revenue_sen / 100 / orders) if orders else 0,
         },
-        'wishlist': {
-            'items_total': wishlist_items_total,
-            'users_with_wishlist': wishlist_users
-        },
-        'conversion': {
-            'paid_over_leads': conversion_rate
-        },
-        'top_products': top_products_sorted
+        'series': series,
+        'top_products': [{ 'productId': p['product_id'], 'units': p['units'] } for p in products],
     }
 
+# --- Order state machine ---
+# Every status change goes through transition_order(), which checks it against
+# ORDER_TRANSITIONS (statuses written before this table existed may move
+# anywhere). Re-applying the current status is a no-op and writes nothing.
+# Abandoned checkouts are expired by a periodic reconciler that reads the
+# (status, updated_at) index, oldest first, in bulk writer jobs.
+ORDER_TRANSITIONS = {
+    'pending_payment': {'payment_initiated', 'payment_pending', 'paid', 'payment_failed', 'expired'},
+    'payment_initiated': {'payment_pending', 'paid', 'payment_failed', 'expired'},
+    'payment_pending': {'paid', 'payment_failed'},
+    'payment_failed': {'payment_initiated', 'payment_pending', 'paid'},
+    # A late gateway success still settles an expired order
+    'expired': {'paid'},
+    'paid': set(),
+}
+PENDING_ORDER_TTL_MINUTES = int(os.environ.get('REWEAVE_PENDING_ORDER_TTL_MINUTES', '60'))
+ORDER_RECONCILE_INTERVAL = 60
+ORDER_RECONCILE_BATCH = 500
+
+class InvalidTransition(Exception):
+    pass
+
+def can_transition(current, status):
+    return current == status or current not in ORDER_TRANSITIONS or status in ORDER_TRANSITIONS[current]
+
+def transition_order(order_id, status, mutate=None, now=None):
+    # Writer job -> (order or None when unknown, whether it was written)
+    order = ORDERS_STORE.get(order_id) if order_id else None
+    if not order:
+        return None, False
+    current = order.get('status') or ''
+    if not can_transition(current, status):
+        raise InvalidTransition(f'{current} -> {status}')
+    if current == status and mutate is None:
+        return order, False
+    order = copy.deepcopy(order)
+    order['status'] = status
+    order['updated_at'] = now or int(time.time() * 1000)
+    if mutate:
+        mutate(order)
+    if current != status:
+        sync_reservation(order_id, current, status, order['updated_at'])
+    ORDERS_STORE.put(order)
+    return order, True
+
+def expire_pending_orders():
+    # Expire checkouts untouched for the TTL (never paid, or sent to the
+    # gateway and abandoned there), releasing their stock; returns how many
+    cutoff = int(time.time() * 1000) - PENDING_ORDER_TTL_MINUTES * 60 * 1000
+    def job(status):
+        stale = orders_in_status(status, cutoff, ORDER_RECONCILE_BATCH)
+        now = int(time.time() * 1000)
+        for o in stale:
+            transition_order(o['id'], 'expired', now=now)
+        return len(stale)
+    total = 0
+    for status in ('pending_payment', 'payment_initiated'):
+        while True:
+            n = WRITER.submit(job, status)
+            total += n
+            if n < ORDER_RECONCILE_BATCH:
+                break
+    if total:
+        print(f'[orders] expired {total} abandoned checkouts')
+    return total
+
+# --- Checkout and stock reservations ---
+# Cart lines are priced from the variants table in one query; client prices
+# and totals are ignored. Placing an order reserves its stock in the writer
+# job that inserts it, so the decrements, the reservation rows and the order
+# commit or roll back together, and the single writer means two checkouts
+# never both take the last unit. Stock goes back when the order moves to
+# payment_failed or expired and is taken again if it moves out (a retried
+# payment; a late settlement is honoured even when it oversells).
+CART_MAX_LINES = 100
+CART_MAX_QTY = 99
+RELEASED_STATUSES = {'payment_failed', 'expired'}
+
+class CartError(Exception):
+    def __init__(self, code, item=None):
+        super().__init__(code)
+        self.code = code
+        self.item = item
+
+class OutOfStock(Exception):
+    def __init__(self, skus):
+        super().__init__('out of stock: ' + ', '.join(skus))
+        self.skus = skus
+
+def cart_quantity(item):
+    try:
+        qty = int(next((item[k] for k in ('quantity', 'qty') if item.get(k) is not None), 1))
+    except (TypeError, ValueError):
+        qty = 0
+    if not 1 <= qty <= CART_MAX_QTY:
+        raise CartError('invalid_quantity', item)
+    return qty
+
+def match_variant(variants, label):
+    # By option label; 'default' (or no label) and single-variant products
+    # take the product's first variant
+    label = str(label or '').strip().lower()
+    if label and label != 'default':
+        for v in variants:
+            if (v[3] or '').lower() == label:
+                return v
+        return variants[0] if len(variants) == 1 else None
+    return variants[0] if variants else None
+
+def cart_ids(item):
+    # (sku, id, productId) as strings or None; numbers are accepted as ids,
+    # lists and objects are not
+    ids = []
+    for field in ('sku', 'id', 'productId'):
+        value = item.get(field)
+        if value is None or value == '':
+            ids.append(None)
+        elif isinstance(value, str) or (isinstance(value, int) and not isinstance(value, bool)):
+            ids.append(str(value))
+        else:
+            raise CartError('invalid_item', item)
+    return tuple(ids)
+
+def price_cart(items):
+    # -> (order lines, total in sen). Items name a sku, or a product id plus
+    # a variant label as the storefront cart stores them.
+    if not isinstance(items, list) or not items:
+        raise CartError('empty_cart')
+    if len(items) > CART_MAX_LINES:
+        raise CartError('too_many_items')
+    keys = set()
+    for item in items:
+        if not isinstance(item, dict):
+            raise CartError('invalid_item', item)
+        keys.update(k for k in cart_ids(item) if k)
+    keys = sorted(keys)
+    marks = ','.join('?' * len(keys))
+    by_sku, by_product = {}, {}
+    for sku, product_id, price, label in WRITER.reader().execute(f"""
+            SELECT sku, product_id, price, option_label FROM variants
+            WHERE sku IN ({marks}) OR product_id IN ({marks}) ORDER BY rowid
+        """, keys + keys):
+        by_sku[sku] = (sku, product_id, price, label)
+        by_product.setdefault(product_id, []).append(by_sku[sku])
+    lines = []
+    total = 0
+    for item in items:
+        sku, item_id, product_id = cart_ids(item)
+        variant = by_sku.get(sku) or by_sku.get(item_id)
+        if variant is None:
+            variant = match_variant(by_product.get(product_id or item_id) or [], item.get('variant'))
+        if variant is None:
+            raise CartError('unknown_item', item)
+        sku, product_id, price, label = variant
+        qty = cart_quantity(item)
+        price_sen = to_sen(price)
+        total += price_sen * qty
+        lines.append({
+            'id': product_id,
+            'sku': sku,
+            'name': item.get('name'),
+            'image': item.get('image'),
+            'variant': label or 'default',
+            'price': price_sen / 100,
+            'quantity': qty,
+            'qty': qty,
+        })
+    return lines, total
+
+def hold_stock(conn, wanted, force=False):
+    # Take {sku: qty} from stock, all or nothing
+    skus = sorted(wanted)
+    stock = dict(conn.execute(
+        f"SELECT sku, stock FROM variants WHERE sku IN ({','.join('?' * len(skus))})", skus).fetchall())
+    short = [sku for sku in skus if stock.get(sku, 0) < wanted[sku]]
+    if short and not force:
+        raise OutOfStock(short)
+    if short:
+        print(f'[stock] oversold {", ".join(short)}')
+    conn.executemany("UPDATE variants SET stock = stock - ? WHERE sku = ?", [(wanted[sku], sku) for sku in skus])
+    WRITER.after_commit(CATALOG.invalidate)
+
+def reserve_stock(order_id, lines, now):
+    # Writer job: hold stock for every line or raise OutOfStock
+    wanted = {}
+    for line in lines:
+        wanted[line['sku']] = wanted.get(line['sku'], 0) + line['quantity']
+    conn = WRITER.db()
+    hold_stock(conn, wanted)
+    conn.executemany(
+        "INSERT INTO stock_reservations (order_id, sku, qty, created_at) VALUES (?, ?, ?, ?)",
+        [(order_id, sku, qty, now) for sku, qty in wanted.items()])
+
+def release_stock(order_id, now):
+    # Writer job: return an order's held stock; returns the units released
+    conn = WRITER.db()
+    held = conn.execute(
+        "SELECT sku, qty FROM stock_reservations WHERE order_id = ? AND released_at IS NULL", (order_id,)).fetchall()
+    if not held:
+        return 0
+    conn.executemany("UPDATE variants SET stock = stock + ? WHERE sku = ?", [(qty, sku) for sku, qty in held])
+    conn.execute("UPDATE stock_reservations SET released_at = ? WHERE order_id = ? AND released_at IS NULL",
+                 (now, order_id))
+    WRITER.after_commit(CATALOG.invalidate)
+    return sum(qty for _, qty in held)
+
+def rehold_stock(order_id, force=False):
+    # Writer job: take released stock again for an order that came back
+    conn = WRITER.db()
+    released = conn.execute(
+        "SELECT sku, qty FROM stock_reservations WHERE order_id = ? AND released_at IS NOT NULL", (order_id,)).fetchall()
+    if not released:
+        return
+    hold_stock(conn, dict(released), force)
+    conn.execute("UPDATE stock_reservations SET released_at = NULL WHERE order_id = ?", (order_id,))
+
+def sync_reservation(order_id, current, status, now):
+    # Called by transition_order before a status change is written
+    if status in RELEASED_STATUSES and current not in RELEASED_STATUSES:
+        release_stock(order_id, now)
+    elif current in RELEASED_STATUSES and status not in RELEASED_STATUSES:
+        rehold_stock(order_id, force=status == 'paid')
+
+def place_order(order):
+    # Writer job: reserve the order's stock and insert it together
+    reserve_stock(order['id'], order['items'], order['created_at'])
+    ORDERS_STORE.append(order)
+    return order
+
+# --- FPX webhook inbox ---
+# The webhook only records the delivery in fpx_inbox (one group-committed
+# insert, ignored when the idempotency key was seen before) and answers 200.
+# A background worker applies pending deliveries in arrival order, a batch
+# per writer job, and marks each one processed with its outcome. Gateway
+# retries of the same delivery therefore cost one indexed lookup and never
+# touch the order. Processed rows are kept REWEAVE_FPX_INBOX_RETENTION_DAYS
+# so late retries are still recognised.
+FPX_INBOX_BATCH = 100
+FPX_INBOX_POLL = 1.0
+FPX_INBOX_RETENTION_DAYS = int(os.environ.get('REWEAVE_FPX_INBOX_RETENTION_DAYS', '30'))
+
+def fpx_idempotency_key(handler, data, body):
+    # An Idempotency-Key header names the delivery itself. A transaction id
+    # is shared by every callback for the payment (pending, then success),
+    # so it only dedupes together with the status; else a digest of the body.
+    key = handler.headers.get('Idempotency-Key')
+    if key:
+        return f'key:{key}'
+    tx = data.get('idempotencyKey') or data.get('transactionId')
+    if tx:
+        return f"tx:{tx}:{str(data.get('status') or '').lower()}"
+    return 'sha1:' + hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+def fpx_order_status(gateway_status):
+    status = (gateway_status or '').lower()
+    if status in ('success', 'paid', 'settled'):
+        return 'paid'
+    if status in ('failed', 'error'):
+        return 'payment_failed'
+    return 'payment_pending'
+
+def record_webhook(key, data):
+    # Writer job; True when the delivery is new
+    cur = WRITER.db().execute("""
+        INSERT OR IGNORE INTO fpx_inbox (idem_key, order_id, status, payload_json, received_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (key, data.get('orderId'), data.get('status'), json.dumps(data), int(time.time() * 1000)))
+    return cur.rowcount == 1
+
+def amount_matches(amount, total):
+    # Client and gateway amounts are MYR, as a number or a string; compared in sen
+    try:
+        return round(float(amount) * 100) == round(float(total) * 100)
+    except (TypeError, ValueError):
+        return False
+
+def apply_webhook(order_id, gateway_status, now, amount=None):
+    # -> outcome stored on the inbox row
+    status = fpx_order_status(gateway_status)
+    if status == 'paid' and amount is not None:
+        order = ORDERS_STORE.get(order_id) if order_id else None
+        if order and not amount_matches(amount, order.get('total')):
+            return f'rejected: paid {amount}, order total {order.get("total")}'
+    try:
+        order, changed = transition_order(order_id, status, now=now)
+    except (InvalidTransition, OutOfStock) as e:
+        return f'rejected: {e}'
+    if not order:
+        return 'unknown_order'
+    return 'applied' if changed else 'unchanged'
+
+def process_inbox_batch():
+    # Writer job: apply the oldest pending deliveries in order
+    conn = WRITER.db()
+    rows = conn.execute("""
+        SELECT seq, order_id, status, payload_json FROM fpx_inbox
+        WHERE processed_at IS NULL ORDER BY seq LIMIT ?
+    """, (FPX_INBOX_BATCH,)).fetchall()
+    now = int(time.time() * 1000)
+    for seq, order_id, status, payload_json in rows:
+        try:
+            payload = json.loads(payload_json or '{}')
+            amount = payload.get('amount') if isinstance(payload, dict) else None
+            result = apply_webhook(order_id, status, now, amount)
+        except Exception as e:
+            result = f'error: {e}'
+        conn.execute("UPDATE fpx_inbox SET processed_at = ?, result = ? WHERE seq = ?", (now, result, seq))
+    return len(rows)
+
+class InboxWorker:
+    def __init__(self):
+        self._wake = threading.Event()
+
+    def notify(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(FPX_INBOX_POLL)
+            self._wake.clear()
+            try:
+                while WRITER.submit(process_inbox_batch) == FPX_INBOX_BATCH:
+                    pass
+            except Exception as e:
+                print('[fpx-inbox] error:', e)
+
+    def start(self):
+        threading.Thread(target=self.run, name='reweave-fpx-inbox', daemon=True).start()
+
+FPX_INBOX = InboxWorker()
+
+def prune_inbox():
+    cutoff = int(time.time() * 1000) - FPX_INBOX_RETENTION_DAYS * 86400 * 1000
+    WRITER.submit(lambda: WRITER.db().execute(
+        "DELETE FROM fpx_inbox WHERE processed_at IS NOT NULL AND processed_at < ?", (cutoff,)))
+
 ALLOWED_ORIGINS = {'http://localhost:8000', 'http://localhost:8080'}
 
 def set_cors(handler):
@@ -375,45 +2385,380 @@ def set_cors(handler):
     handler.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
     handler.send_header('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,OPTIONS')
 
-def json_response(handler, payload, status=200):
+def bytes_response(handler, body, status=200, content_type='application/json', headers=None):
+    # Always send Content-Length so HTTP/1.1 keep-alive connections stay usable
     handler.send_response(status)
-    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Type', content_type)
+    handler.send_header('Content-Length', str(len(body)))
+    for k, v in (headers or {}).items():
+        handler.send_header(k, v)
     set_cors(handler)
     handler.end_headers()
-    handler.wfile.write(json.dumps(payload).encode('utf-8'))
+    handler.wfile.write(body)
+
+def json_response(handler, payload, status=200, headers=None):
+    bytes_response(handler, json.dumps(payload).encode('utf-8'), status, 'application/json', headers)
 
 def text_response(handler, payload_text, status=200, content_type='text/plain'):
-    handler.send_response(status)
-    handler.send_header('Content-Type', content_type)
+    bytes_response(handler, payload_text.encode('utf-8'), status, content_type)
+
+def session_response(handler, sess, user):
+    safe_user = { k: user.get(k) for k in ['id','email','name','phone','marketing_consent'] }
+    cookie = f"reweave_session={sess['token']}; Path=/; HttpOnly; SameSite=Lax"
+    json_response(handler, { 'ok': True, 'token': sess['token'], 'user': safe_user }, 200, { 'Set-Cookie': cookie })
+
+# --- Event ingestion ---
+# Tracking events are accepted into a fixed-size ring buffer and persisted by
+# a background flusher in bulk (one writer job, one fsync per flush), so a
+# page firing dozens of events costs a few appends to memory. When the ring
+# has no room for a whole batch the request is refused with 429 and nothing
+# from it is queued. Accepted events are durable once the next flush commits.
+EVENT_BUFFER_SIZE = int(os.environ.get('REWEAVE_EVENT_BUFFER', '10000'))
+EVENT_FLUSH_MS = float(os.environ.get('REWEAVE_EVENT_FLUSH_MS', '50'))
+EVENT_BATCH_MAX = int(os.environ.get('REWEAVE_EVENT_BATCH_MAX', '500'))
+
+class EventIds:
+    # evt_<n> with n = max(now in ms, previous + 1): strictly increasing, so
+    # two events in the same millisecond never share an id, and still the
+    # millisecond timestamp format the existing ids use
+    def __init__(self, records=(), prefix='evt'):
+        self._lock = threading.Lock()
+        self.prefix = prefix
+        self._last = 0
+        for r in records:
+            try:
+                self._last = max(self._last, int(str(r.get('id', '')).split('_', 1)[1]))
+            except (IndexError, ValueError):
+                pass
+
+    def next(self):
+        with self._lock:
+            self._last = max(int(time.time() * 1000), self._last + 1)
+            return f'{self.prefix}_{self._last}'
+
+EVENT_IDS = EventIds(itertools.islice(scan_events(order='desc'), 1000))
+# Order ids share the format; unique within the process and past ids are
+# older than the restart
+ORDER_IDS = EventIds(prefix='order')
+
+class EventBuffer:
+    def __init__(self, capacity, flush_ms):
+        self.capacity = capacity
+        self.interval = flush_ms / 1000.0
+        self._ring = [None] * capacity
+        self._head = 0
+        self._size = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._taken = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.flushed = 0
+
+    def offer(self, events):
+        # All or nothing; False when the ring can't take the whole batch
+        with self._cond:
+            if self._size + len(events) > self.capacity:
+                self.rejected += len(events)
+                return False
+            for e in events:
+                self._ring[(self._head + self._size) % self.capacity] = e
+                self._size += 1
+            self.accepted += len(events)
+            if self._size >= self.capacity // 2:
+                self._cond.notify()
+            return True
+
+    def _peek(self):
+        with self._cond:
+            return [self._ring[(self._head + i) % self.capacity] for i in range(self._size)]
+
+    def _discard(self, n):
+        with self._cond:
+            for _ in range(n):
+                self._ring[self._head] = None
+                self._head = (self._head + 1) % self.capacity
+            self._size -= n
+
+    def flush(self):
+        # Events leave the ring once the archive has taken them. A failed write
+        # keeps the rest (and their capacity) for the next flush rather than
+        # dropping events already answered with 202; the ones the archive took
+        # before the failure are in its memory and segment file, so they go
+        # too, or the retry would store them twice.
+        with self._flush_lock:
+            batch = self._peek()
+            if not batch:
+                return 0
+            self._taken = 0
+            try:
+                WRITER.submit(self._append, batch)
+            finally:
+                self._discard(self._taken)
+                self.flushed += self._taken
+            return len(batch)
+
+    def _append(self, batch):
+        # Writer job
+        for e in batch:
+            EVENTS_STORE.append(e)
+            self._taken += 1
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print('[events] flush failed:', e)
+
+    def start(self):
+        threading.Thread(target=self.run, name='reweave-event-flush', daemon=True).start()
+
+    def stats(self):
+        with self._cond:
+            return { 'buffered': self._size, 'capacity': self.capacity, 'accepted': self.accepted,
+                     'rejected': self.rejected, 'flushed': self.flushed }
+
+EVENT_BUFFER = EventBuffer(EVENT_BUFFER_SIZE, EVENT_FLUSH_MS)
+
+def make_event(ev_type, payload, ua, ts=None):
+    return {
+        'id': EVENT_IDS.next(),
+        'type': ev_type,
+        'payload': payload,
+        'ts': ts or int(time.time() * 1000),
+        'ua': ua,
+    }
+
+def normalize_event(raw, ua):
+    # Accepts { type, payload } and the storefront tracker's flat
+    # { event, timestamp, session_id, user_agent, ...props } shape
+    if not isinstance(raw, dict):
+        return None
+    ev_type = raw.get('type') or raw.get('event')
+    if not ev_type or not isinstance(ev_type, str):
+        return None
+    if 'payload' in raw:
+        payload = raw.get('payload') or {}
+    else:
+        payload = { k: v for k, v in raw.items() if k not in ('type', 'event', 'user_agent') }
+    return make_event(ev_type, payload, raw.get('user_agent') or ua)
+
+# --- CSV export ---
+# Exports stream rows as they are read from the store instead of building the
+# whole file in memory: csv.writer (RFC 4180 quoting, CRLF rows) fills a small
+# buffer which is flushed as one HTTP/1.1 chunk every CSV_CHUNK_BYTES.
+CSV_CHUNK_BYTES = 64 * 1024
+
+def parse_time_param(value):
+    # Epoch milliseconds or an ISO date/datetime (naive values are UTC)
+    if not value:
+        return None
+    value = value.strip()
+    if value.lstrip('-').isdigit():
+        return int(value)
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def time_filter(query):
+    # Returns (since, until) in ms from ?since=&until=; until is exclusive
+    since = parse_time_param((query.get('since') or [''])[0])
+    until = parse_time_param((query.get('until') or [''])[0])
+    return since, until
+
+def in_range(ts, since, until):
+    try:
+        ts = int(ts)
+    except (TypeError, ValueError):
+        return since is None and until is None
+    return (since is None or ts >= since) and (until is None or ts < until)
+
+class ChunkedWriter:
+    def __init__(self, wfile, chunked):
+        self.wfile = wfile
+        self.chunked = chunked
+
+    def write(self, data):
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        else:
+            self.wfile.write(data)
+
+    def close(self):
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+def wants_gzip(handler, query):
+    if (query.get('gzip') or [''])[0] in ('1', 'true'):
+        return True
+    return 'gzip' in (handler.headers.get('Accept-Encoding') or '')
+
+def stream_csv(handler, filename, cols, rows, compress=False):
+    # rows is an iterable of lists; nothing is materialized beyond one buffer
+    chunked = handler.request_version == 'HTTP/1.1' and handler.protocol_version == 'HTTP/1.1'
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/csv; charset=utf-8')
+    handler.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+    handler.send_header('Cache-Control', 'no-store')
+    if compress:
+        handler.send_header('Content-Encoding', 'gzip')
+        handler.send_header('Vary', 'Accept-Encoding')
+    if chunked:
+        handler.send_header('Transfer-Encoding', 'chunked')
+    else:
+        # Without chunking the body is delimited by closing the connection
+        handler.close_connection = True
+        handler.send_header('Connection', 'close')
     set_cors(handler)
     handler.end_headers()
-    handler.wfile.write(payload_text.encode('utf-8'))
 
-def hash_password(password: str) -> dict:
+    out = ChunkedWriter(handler.wfile, chunked)
+    deflate = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    def flush():
+        data = buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+        out.write(deflate.compress(data) if deflate else data)
+
+    writer.writerow(cols)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CSV_CHUNK_BYTES:
+            flush()
+    flush()
+    if deflate:
+        out.write(deflate.flush())
+    out.close()
+
+def lead_csv_rows(leads, since=None, until=None):
+    for l in leads:
+        if in_range(l.get('ts'), since, until):
+            yield [l.get('id', ''), l.get('name', ''), l.get('phone', ''),
+                   l.get('interest', ''), l.get('source', ''), l.get('ts', '')]
+
+def event_csv_rows(events):
+    for e in events:
+        yield [e.get('id', ''), e.get('type', ''), e.get('ts', ''),
+               e.get('ua', ''), json.dumps(e.get('payload', {}))]
+
+# --- Password hashing ---
+# Hash parameters are versioned per user (password_version, missing = 1). To
+# raise the cost add a version and point REWEAVE_HASH_VERSION at it: existing
+# hashes keep verifying with the parameters they were made with and are
+# re-hashed with the current version on the user's next successful login.
+HASH_VERSIONS = {
+    1: { 'digest': 'sha256', 'iterations': 100_000 },
+    2: { 'digest': 'sha256', 'iterations': 600_000 },
+}
+CURRENT_HASH_VERSION = int(os.environ.get('REWEAVE_HASH_VERSION', '1'))
+# pbkdf2_hmac releases the GIL, so a thread pool runs hashes on every core.
+# At most HASH_WORKERS + HASH_QUEUE requests may wait on hashing, and never
+# more than the HTTP pool minus HASH_RESERVED_WORKERS (a quarter of it by
+# default), so catalog and cart requests always get workers.
+HASH_WORKERS = int(os.environ.get('REWEAVE_HASH_WORKERS', str(os.cpu_count() or 1)))
+HASH_QUEUE = int(os.environ.get('REWEAVE_HASH_QUEUE', str(HASH_WORKERS * 2)))
+HASH_RESERVED_WORKERS = os.environ.get('REWEAVE_HASH_RESERVED_WORKERS')
+HASH_POOL = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='reweave-hash')
+
+def hash_admission_limit(workers):
+    reserve = int(HASH_RESERVED_WORKERS) if HASH_RESERVED_WORKERS else max(1, workers // 4)
+    return max(1, min(HASH_WORKERS + HASH_QUEUE, workers - reserve))
+
+def limit_hashing(workers):
+    # Re-derive the admission bound for the pool size actually served
+    global HASH_SLOTS
+    HASH_SLOTS = threading.BoundedSemaphore(hash_admission_limit(workers))
+
+HASH_SLOTS = threading.BoundedSemaphore(hash_admission_limit(WORKERS))
+
+class HashingBusy(Exception):
+    pass
+
+def hash_password(password: str, version: int = None) -> dict:
+    version = version or CURRENT_HASH_VERSION
+    params = HASH_VERSIONS[version]
     salt = secrets.token_bytes(16)
-    dk = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100_000)
+    dk = hashlib.pbkdf2_hmac(params['digest'], password.encode('utf-8'), salt, params['iterations'])
     return {
         'salt': base64.b64encode(salt).decode('utf-8'),
-        'hash': base64.b64encode(dk).decode('utf-8')
+        'hash': base64.b64encode(dk).decode('utf-8'),
+        'version': version
     }
 
-def verify_password(password: str, salt_b64: str, hash_b64: str) -> bool:
+def verify_password(password: str, salt_b64: str, hash_b64: str, version: int = 1) -> bool:
     try:
+        params = HASH_VERSIONS[int(version or 1)]
         salt = base64.b64decode(salt_b64.encode('utf-8'))
         expected = base64.b64decode(hash_b64.encode('utf-8'))
-        dk = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100_000)
+        dk = hashlib.pbkdf2_hmac(params['digest'], password.encode('utf-8'), salt, params['iterations'])
         return secrets.compare_digest(dk, expected)
     except Exception:
         return False
 
+def run_hashing(fn, *args):
+    # Admission control: reject immediately instead of queueing without bound
+    if not HASH_SLOTS.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        return HASH_POOL.submit(fn, *args).result()
+    finally:
+        HASH_SLOTS.release()
+
+def busy_response(handler):
+    return json_response(handler, { 'ok': False, 'error': 'busy' }, 503, { 'Retry-After': '1' })
+
 def create_session(user_id: str) -> dict:
     token = secrets.token_hex(32)
-    sessions = read_sessions()
-    sess = { 'id': f'sess_{int(__import__("time").time()*1000)}', 'token': token, 'user_id': user_id, 'created_at': int(__import__('time').time()*1000) }
-    sessions.append(sess)
-    write_sessions(sessions)
+    now_ms = int(__import__('time').time()*1000)
+    sess = { 'id': f'sess_{now_ms}', 'token': token, 'user_id': user_id, 'created_at': now_ms, 'expires_at': now_ms + SESSION_TTL_MS }
+    WRITER.submit(SESSIONS_STORE.append, sess)
     return sess
 
+def session_expired(sess, now_ms):
+    # Sessions created before expiry existed age out from created_at
+    return (sess.get('expires_at') or (sess.get('created_at') or 0) + SESSION_TTL_MS) <= now_ms
+
+def prune_expired():
+    # Drop expired sessions and one-time codes so the stores stop growing
+    now_ms = int(time.time()*1000)
+    def job():
+        removed = SESSIONS_STORE.remove(lambda s: session_expired(s, now_ms))
+        OTPS_STORE.remove(lambda o: o.get('expires', 0) <= now_ms)
+        return removed
+    return WRITER.submit(job)
+
+def run_periodically(name, interval, fn):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                fn()
+            except Exception as e:
+                print(f'[{name}] error:', e)
+    threading.Thread(target=loop, name=f'reweave-{name}', daemon=True).start()
+
+def start_background_tasks():
+    run_periodically('session-prune', SESSION_PRUNE_INTERVAL, prune_expired)
+    EVENT_BUFFER.start()
+    FPX_INBOX.start()
+    run_periodically('order-reconcile', ORDER_RECONCILE_INTERVAL, expire_pending_orders)
+    FPX_INBOX.notify()
+    run_periodically('fpx-inbox-prune', 86400, prune_inbox)
+    if isinstance(EVENTS_STORE, EventArchive):
+        WRITER.submit(EVENTS_STORE.seal)
+        run_periodically('event-seal', 60, lambda: WRITER.submit(EVENTS_STORE.seal))
+    if METRICS_CHECK_INTERVAL > 0:
+        run_periodically('metrics-check', METRICS_CHECK_INTERVAL, check_metrics)
+
 def get_token_from_headers(handler) -> str:
     auth = handler.headers.get('Authorization', '')
     if auth.startswith('Bearer '):
@@ -430,17 +2775,31 @@ def get_user_from_request(handler):
     token = get_token_from_headers(handler)
     if not token:
         return None
-    sessions = read_sessions()
-    users = read_users()
-    sess = next((s for s in sessions if s.get('token') == token), None)
-    if not sess:
+    sess = SESSIONS_STORE.get(token)
+    if not sess or session_expired(sess, int(time.time()*1000)):
         return None
-    user = next((u for u in users if u.get('id') == sess.get('user_id')), None)
-    return user
+    return USERS_STORE.get(sess.get('user_id'))
 
 class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 enables keep-alive; idle connections are dropped after the
+    # timeout so they can't pin a pool worker forever
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out in separate writes; without this a reused
+    # connection stalls on Nagle + delayed ACK
+    disable_nagle_algorithm = True
+
+    def end_headers(self):
+        # Hand the worker to a queued connection instead of holding it for
+        # this client's next request
+        saturated = getattr(self.server, 'saturated', None)
+        if saturated and saturated() and not self.close_connection:
+            self.send_header('Connection', 'close')
+        super().end_headers()
+
     def do_OPTIONS(self):
         self.send_response(204)
+        self.send_header('Content-Length', '0')
         set_cors(self)
         self.end_headers()
 
@@ -450,123 +2809,109 @@ class Handler(BaseHTTPRequestHandler):
         if parsed.path == '/api/health':
             return json_response(self, { 'ok': True, 'service': 'reweave-backend', 'time': __import__('datetime').datetime.utcnow().isoformat() })
         if parsed.path == '/api/products':
-            prods = read_products()
-            return json_response(self, { 'ok': True, 'products': prods })
+            if not any(k in query for k in ('limit', 'cursor', 'fields', 'order')):
+                return catalog_response(self)
+            try:
+                paged, limit, after, fields, reverse = page_params(query)
+            except ValueError:
+                return json_response(self, { 'ok': False, 'error': 'invalid_query' }, 400)
+            snap = CATALOG.get()
+            products = snap['products'][::-1] if reverse else snap['products']
+            start = 0
+            if after is not None:
+                pos = snap['positions'].get(after[0])
+                if pos is None:
+                    return json_response(self, { 'ok': False, 'error': 'invalid_cursor' }, 400)
+                start = (len(products) - pos if reverse else pos + 1)
+            rows, next_cursor = page_of(iter(products[start:]), limit if paged else len(products), lambda p: [p.get('id')])
+            return list_response(self, 'products', rows, fields, next_cursor, paged)
         # Product detail by id
         if parsed.path.startswith('/api/products/'):
             product_id = parsed.path.split('/api/products/', 1)[1]
             if not product_id:
                 return json_response(self, { 'ok': False, 'error': 'product_id_required' }, 400)
-            # Try DB first
+            # DB first: two indexed lookups for the product and its variants
             if db_has_products():
                 try:
-                    conn = db_conn()
-                    conn.row_factory = sqlite3.Row
-                    cur = conn.cursor()
-                    cur.execute("SELECT id, title, description, category, images_json FROM products WHERE id = ?", (product_id,))
-                    row = cur.fetchone()
-                    if row:
-                        product = {
-                            'id': row['id'],
-                            'title': row['title'],
-                            'description': row['description'],
-                            'category': row['category'],
-                            'images': json.loads(row['images_json'] or '[]'),
-                        }
-                        cur.execute("SELECT sku, price, stock, options_json FROM variants WHERE product_id = ?", (product_id,))
-                        variants = []
-                        for v in cur.fetchall():
-                            variants.append({
-                                'sku': v['sku'],
-                                'price': v['price'],
-                                'stock': v['stock'],
-                                'options': json.loads(v['options_json'] or '{}')
-                            })
-                        product['variants'] = variants
-                        conn.close()
-                        return json_response(self, { 'ok': True, 'product': product })
-                    # Not in DB, fall back to file
-                    conn.close()
-                except Exception:
-                    try:
-                        conn.close()
-                    except Exception:
-                        pass
+                    product = get_product_from_db(product_id)
+                    if product is None:
+                        return json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
+                    return json_response(self, { 'ok': True, 'product': product })
+                except Exception as e:
+                    print('[products] db lookup failed, using products.json:', e)
+            # No catalog in the DB yet
             prods = read_products_file()
             prod = next((p for p in prods if (p.get('id') == product_id or p.get('productId') == product_id)), None)
             if not prod:
                 return json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
             return json_response(self, { 'ok': True, 'product': prod })
         if parsed.path == '/api/leads':
-            leads = read_leads()
-            return json_response(self, { 'ok': True, 'count': len(leads), 'leads': leads })
+            try:
+                paged, limit, after, fields, reverse = page_params(query)
+            except ValueError:
+                return json_response(self, { 'ok': False, 'error': 'invalid_query' }, 400)
+            if not paged:
+                leads = read_leads()
+                return list_response(self, 'leads', leads[::-1] if reverse else leads, fields)
+            leads, next_cursor = store_page(LEADS_STORE, after, limit, reverse)
+            return list_response(self, 'leads', leads, fields, next_cursor, True)
         if parsed.path == '/api/events':
-            events = read_events()
-            return json_response(self, { 'ok': True, 'count': len(events), 'events': events })
-
-        if parsed.path == '/api/leads.csv':
-            leads = read_leads()
-            cols = ['id','name','phone','interest','source','ts']
-            lines = [','.join(cols)]
-            for l in leads:
-                row = [
-                    str(l.get('id','')),
-                    str(l.get('name','')).replace(',', ';'),
-                    str(l.get('phone','')).replace(',', ''),
-                    str(l.get('interest','')).replace(',', ';'),
-                    str(l.get('source','')).replace(',', ';'),
-                    str(l.get('ts',''))
-                ]
-                lines.append(','.join(row))
-            return text_response(self, '\n'.join(lines), 200, 'text/csv')
-
-        if parsed.path == '/api/events.csv':
-            events = read_events()
+            # Also filtered by ?since=&until=&type=; the cursor is the (ts, id) of the last row
+            try:
+                paged, limit, after, fields, reverse = page_params(query)
+                since, until = time_filter(query)
+                if after is not None and (len(after) != 2 or not isinstance(after[0], int)):
+                    raise ValueError('invalid cursor')
+            except ValueError:
+                return json_response(self, { 'ok': False, 'error': 'invalid_query' }, 400)
+            types = {t for v in query.get('type', []) for t in v.split(',') if t}
+            rows = scan_events(since, until, types, 'desc' if reverse else 'asc', after)
+            if not paged:
+                return list_response(self, 'events', list(rows), fields)
+            events, next_cursor = page_of(rows, limit, event_key)
+            return list_response(self, 'events', events, fields, next_cursor, True)
+
+        if parsed.path in ('/api/leads.csv', '/api/events.csv'):
+            query = parse_qs(parsed.query)
+            try:
+                since, until = time_filter(query)
+            except ValueError:
+                return json_response(self, { 'ok': False, 'error': 'invalid_time_range' }, 400)
+            compress = wants_gzip(self, query)
+            if parsed.path == '/api/leads.csv':
+                cols = ['id','name','phone','interest','source','ts']
+                return stream_csv(self, 'leads.csv', cols, lead_csv_rows(read_leads(), since, until), compress)
+            types = {t for v in query.get('type', []) for t in v.split(',') if t}
             cols = ['id','type','ts','ua','payload']
-            lines = [','.join(cols)]
-            for e in events:
-                payload_str = json.dumps(e.get('payload', {})).replace(',', ';')
-                row = [
-                    str(e.get('id','')),
-                    str(e.get('type','')).replace(',', ';'),
-                    str(e.get('ts','')),
-                    str(e.get('ua','')).replace(',', ';'),
-                    payload_str
-                ]
-                lines.append(','.join(row))
-            return text_response(self, '\n'.join(lines), 200, 'text/csv')
+            return stream_csv(self, 'events.csv', cols, event_csv_rows(scan_events(since, until, types)), compress)
+
         # Inventory lookup by SKU
         if parsed.path.startswith('/api/inventory/'):
             sku = parsed.path.split('/api/inventory/', 1)[1]
             if not sku:
                 return json_response(self, { 'ok': False, 'error': 'sku_required' }, 400)
-            # Try DB first
+            # DB first: one covering-index lookup joined to the product title
             if db_has_products():
                 try:
-                    conn = db_conn()
-                    conn.row_factory = sqlite3.Row
-                    cur = conn.cursor()
-                    cur.execute("SELECT sku, product_id, price, stock, options_json FROM variants WHERE sku = ?", (sku,))
-                    v = cur.fetchone()
-                    if v:
-                        cur.execute("SELECT title FROM products WHERE id = ?", (v['product_id'],))
-                        p = cur.fetchone()
-                        payload = {
-                            'sku': v['sku'],
-                            'productId': v['product_id'],
-                            'productTitle': (p['title'] if p else ''),
-                            'price': v['price'],
-                            'stock': v['stock'],
-                            'options': json.loads(v['options_json'] or '{}')
-                        }
-                        conn.close()
-                        return json_response(self, { 'ok': True, 'inventory': payload })
-                    conn.close()
-                except Exception:
-                    try:
-                        conn.close()
-                    except Exception:
-                        pass
+                    v = db_conn().execute("""
+                        SELECT v.sku, v.product_id, v.price, v.stock, v.options_json, p.title
+                        FROM variants v INDEXED BY idx_variants_sku
+                        LEFT JOIN products p ON p.id = v.product_id
+                        WHERE v.sku = ?
+                    """, (sku,)).fetchone()
+                    if not v:
+                        return json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
+                    payload = {
+                        'sku': v['sku'],
+                        'productId': v['product_id'],
+                        'productTitle': v['title'] or '',
+                        'price': v['price'],
+                        'stock': v['stock'],
+                        'options': json.loads(v['options_json'] or '{}')
+                    }
+                    return json_response(self, { 'ok': True, 'inventory': payload })
+                except Exception as e:
+                    print('[inventory] db lookup failed, using products.json:', e)
             # Fallback to products.json
             prods = read_products_file()
             for p in prods:
@@ -583,13 +2928,32 @@ class Handler(BaseHTTPRequestHandler):
                         return json_response(self, { 'ok': True, 'inventory': payload })
             return json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
         if parsed.path == '/api/events/summary':
-            events = read_events()
-            summary = {}
-            for e in events:
-                t = e.get('type','unknown')
-                summary[t] = summary.get(t, 0) + 1
-            return json_response(self, { 'ok': True, 'summary': summary })
+            try:
+                since, until = time_filter(parse_qs(parsed.query or ''))
+            except ValueError:
+                return json_response(self, { 'ok': False, 'error': 'invalid_time_range' }, 400)
+            return json_response(self, { 'ok': True, 'summary': event_summary(since, until) })
         if parsed.path == '/api/analytics/metrics':
+            qs = parse_qs(parsed.query or '')
+            if any(k in qs for k in ('from', 'to', 'granularity')):
+                # Arbitrary ranges come from the rollup tables
+                granularity = (qs.get('granularity') or ['day'])[0]
+                if granularity not in ROLLUP_FORMATS:
+                    return json_response(self, { 'ok': False, 'error': 'invalid_granularity' }, 400)
+                try:
+                    until = parse_time_param((qs.get('to') or [''])[0]) or int(time.time() * 1000)
+                    since = parse_time_param((qs.get('from') or [''])[0])
+                except ValueError:
+                    return json_response(self, { 'ok': False, 'error': 'invalid_time_range' }, 400)
+                if since is None:
+                    since = until - 30 * 86400 * 1000
+                if since >= until:
+                    return json_response(self, { 'ok': False, 'error': 'invalid_time_range' }, 400)
+                return json_response(self, { 'ok': True, 'metrics': query_rollups(since, until, granularity) })
+            if (qs.get('check') or [''])[0] in ('1', 'true'):
+                # Recompute from the stores and report whether the aggregates had drifted
+                consistent = WRITER.submit(METRICS.rebuild)
+                return json_response(self, { 'ok': True, 'consistent': consistent, 'metrics': compute_analytics_metrics() })
             metrics = compute_analytics_metrics()
             return json_response(self, { 'ok': True, 'metrics': metrics })
         if parsed.path == '/api/auth/session':
@@ -604,28 +2968,17 @@ class Handler(BaseHTTPRequestHandler):
             token = (qs.get('token', [''])[0] or '').strip()
             if not token:
                 return json_response(self, { 'ok': False, 'error': 'token_required' }, 400)
-            otps = read_otps()
             now_ms = int(__import__('time').time()*1000)
-            match = next((o for o in otps if o.get('type') == 'magic' and o.get('token') == token and o.get('expires',0) > now_ms), None)
+            # Redeem and clean up the magic token atomically
+            match = consume_otp(lambda o: o.get('type') == 'magic' and o.get('token') == token and o.get('expires',0) > now_ms)
             if not match:
                 return json_response(self, { 'ok': False, 'error': 'invalid_or_expired_token' }, 400)
             email = match.get('email')
-            users = read_users()
-            user = next((u for u in users if u.get('email') == email), None)
+            user = USERS_STORE.find('email', email)
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'user_not_found' }, 404)
-            # Clean up magic token
-            otps = [o for o in otps if not (o.get('type') == 'magic' and o.get('token') == token)]
-            write_otps(otps)
             sess = create_session(user['id'])
-            self.send_response(200)
-            set_cors(self)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Set-Cookie', f"reweave_session={sess['token']}; Path=/; HttpOnly; SameSite=Lax")
-            self.end_headers()
-            safe_user = { k: user.get(k) for k in ['id','email','name','phone','marketing_consent'] }
-            self.wfile.write(json.dumps({ 'ok': True, 'token': sess['token'], 'user': safe_user }).encode('utf-8'))
-            return
+            return session_response(self, sess, user)
 
         if parsed.path == '/api/me':
             user = get_user_from_request(self)
@@ -666,19 +3019,31 @@ class Handler(BaseHTTPRequestHandler):
         if parsed.path == '/api/orders':
             # If ?all=1 provide all orders (dev convenience), else auth user's orders
             if query.get('all', ['0'])[0] == '1':
-                orders = read_orders()
-                return json_response(self, { 'ok': True, 'orders': orders })
+                try:
+                    paged, limit, after, fields, reverse = page_params(query)
+                except ValueError:
+                    return json_response(self, { 'ok': False, 'error': 'invalid_query' }, 400)
+                if not paged:
+                    orders = read_orders()
+                    return list_response(self, 'orders', orders[::-1] if reverse else orders, fields)
+                orders, next_cursor = store_page(ORDERS_STORE, after, limit, reverse)
+                return list_response(self, 'orders', orders, fields, next_cursor, True)
             user = get_user_from_request(self)
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'unauthorized' }, 401)
-            orders = read_orders()
-            my_orders = [o for o in orders if o.get('user_id') == user.get('id')]
-            return json_response(self, { 'ok': True, 'orders': my_orders })
+            try:
+                paged, limit, after, fields, _ = page_params(query)
+            except ValueError:
+                return json_response(self, { 'ok': False, 'error': 'invalid_query' }, 400)
+            if not paged:
+                return list_response(self, 'orders', orders_for_user(user.get('id')), fields)
+            orders = orders_for_user(user.get('id'), after[0] if after else None, limit + 1)
+            next_cursor = encode_cursor([orders[limit - 1].get('id')]) if len(orders) > limit else None
+            return list_response(self, 'orders', orders[:limit], fields, next_cursor, True)
 
         if parsed.path.startswith('/api/orders/'):
             order_id = parsed.path.split('/api/orders/', 1)[1]
-            orders = read_orders()
-            order = next((o for o in orders if o.get('id') == order_id), None)
+            order = ORDERS_STORE.get(order_id)
             if not order:
                 return json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
             user = get_user_from_request(self)
@@ -708,88 +3073,91 @@ class Handler(BaseHTTPRequestHandler):
             source = data.get('source', 'onepage')
             if not phone:
                 return json_response(self, { 'ok': False, 'error': 'phone_required' }, 400)
-            leads = read_leads()
             lead = { 'id': f'lead_{int(__import__("time").time()*1000)}', 'name': name, 'phone': phone, 'interest': interest, 'source': source, 'ts': int(__import__('time').time()*1000) }
-            leads.append(lead)
-            write_leads(leads)
+            WRITER.submit(LEADS_STORE.append, lead)
             return json_response(self, { 'ok': True, 'lead': lead })
 
         if parsed.path == '/api/checkout':
-            items = data.get('items', [])
-            total = data.get('total', 0)
-            currency = data.get('currency', 'MYR')
+            # Prices are MYR; the order's currency is not the client's to pick
+            if data.get('currency', 'MYR') != 'MYR':
+                return json_response(self, { 'ok': False, 'error': 'unsupported_currency' }, 400)
+            try:
+                lines, total_sen = price_cart(data.get('items'))
+            except CartError as e:
+                return json_response(self, { 'ok': False, 'error': e.code, 'item': e.item }, 400)
             user = get_user_from_request(self)
-            orders = read_orders()
-            order_id = f'order_{int(__import__("time").time()*1000)}'
+            now = int(time.time() * 1000)
             order = {
-                'id': order_id,
+                'id': ORDER_IDS.next(),
                 'user_id': user.get('id') if user else None,
-                'items': items,
-                'total': total,
-                'currency': currency,
+                'items': lines,
+                'total': total_sen / 100,
+                'currency': 'MYR',
                 'status': 'pending_payment',
-                'created_at': int(__import__('time').time()*1000),
-                'updated_at': int(__import__('time').time()*1000)
+                'created_at': now,
+                'updated_at': now
             }
-            orders.append(order)
-            write_orders(orders)
-            return json_response(self, { 'ok': True, 'orderId': order_id, 'total': total })
+            try:
+                WRITER.submit(place_order, order)
+            except OutOfStock as e:
+                return json_response(self, { 'ok': False, 'error': 'out_of_stock', 'skus': e.skus }, 409)
+            return json_response(self, { 'ok': True, 'orderId': order['id'], 'total': order['total'], 'items': lines })
 
         if parsed.path == '/api/fpx/initiate':
             order_id = data.get('orderId', '')
-            amount = data.get('amount', 0)
             name = data.get('name', '')
+            order = ORDERS_STORE.get(order_id) if isinstance(order_id, str) else None
+            if not order:
+                return json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
+            # The gateway charges the order's own total; a client amount is
+            # only a cross-check
+            amount = order['total']
+            if data.get('amount') is not None and not amount_matches(data['amount'], amount):
+                return json_response(self, { 'ok': False, 'error': 'amount_mismatch', 'total': amount }, 409)
             redirect_url = f'/pages/checkout/fpx.html?name={name}&price={amount}&id={order_id}'
             # Update order status to payment_initiated
-            orders = read_orders()
-            updated = False
-            for o in orders:
-                if o.get('id') == order_id:
-                    o['status'] = 'payment_initiated'
-                    o['updated_at'] = int(__import__('time').time()*1000)
-                    o['payment'] = { 'provider': 'fpx', 'amount': amount, 'name': name }
-                    updated = True
-                    break
-            if updated:
-                write_orders(orders)
+            def mark_initiated(o):
+                o['payment'] = { 'provider': 'fpx', 'amount': amount, 'name': name }
+            try:
+                WRITER.submit(transition_order, order_id, 'payment_initiated', mark_initiated)
+            except InvalidTransition as e:
+                return json_response(self, { 'ok': False, 'error': 'invalid_transition', 'detail': str(e) }, 409)
+            except OutOfStock as e:
+                return json_response(self, { 'ok': False, 'error': 'out_of_stock', 'skus': e.skus }, 409)
             return json_response(self, { 'ok': True, 'redirectUrl': redirect_url })
 
         if parsed.path == '/api/fpx/webhook':
-            # Expect { orderId, status }
-            order_id = data.get('orderId')
-            status = (data.get('status') or '').lower()
-            orders = read_orders()
-            for o in orders:
-                if o.get('id') == order_id:
-                    if status in ('success','paid','settled'):
-                        o['status'] = 'paid'
-                    elif status in ('failed','error'):
-                        o['status'] = 'payment_failed'
-                    else:
-                        o['status'] = 'payment_pending'
-                    o['updated_at'] = int(__import__('time').time()*1000)
-                    break
-            write_orders(orders)
-            print('FPX webhook:', data)
-            return json_response(self, { 'ok': True })
+            # Expect { orderId, status[, amount] }; recorded here, applied by the inbox worker
+            key = fpx_idempotency_key(self, data, body)
+            new = WRITER.submit(record_webhook, key, data)
+            if new:
+                FPX_INBOX.notify()
+                print('FPX webhook:', data)
+            return json_response(self, { 'ok': True, 'duplicate': not new })
 
         if parsed.path == '/api/events':
             ev_type = data.get('type')
             payload = data.get('payload', {})
             if not ev_type:
                 return json_response(self, { 'ok': False, 'error': 'type_required' }, 400)
-            events = read_events()
-            event = {
-                'id': f'evt_{int(__import__("time").time()*1000)}',
-                'type': ev_type,
-                'payload': payload,
-                'ts': int(__import__('time').time()*1000),
-                'ua': self.headers.get('User-Agent', '')
-            }
-            events.append(event)
-            write_events(events)
+            event = make_event(ev_type, payload, self.headers.get('User-Agent', ''))
+            WRITER.submit(EVENTS_STORE.append, event)
             return json_response(self, { 'ok': True, 'event': event })
 
+        if parsed.path in ('/api/events/batch', '/api/analytics'):
+            # /api/analytics is where shared/script.js sends its queued events
+            raw = data if isinstance(data, list) else data.get('events')
+            if not isinstance(raw, list) or not raw:
+                return json_response(self, { 'ok': False, 'error': 'events_required' }, 400)
+            if len(raw) > EVENT_BATCH_MAX:
+                return json_response(self, { 'ok': False, 'error': 'batch_too_large', 'max': EVENT_BATCH_MAX }, 413)
+            ua = self.headers.get('User-Agent', '')
+            events = [e for e in (normalize_event(r, ua) for r in raw) if e]
+            if events and not EVENT_BUFFER.offer(events):
+                return json_response(self, { 'ok': False, 'error': 'buffer_full' }, 429, { 'Retry-After': '1' })
+            return json_response(self, { 'ok': True, 'accepted': len(events), 'rejected': len(raw) - len(events),
+                                         'ids': [e['id'] for e in events] }, 202)
+
         if parsed.path == '/api/auth/signup':
             email = (data.get('email') or '').strip().lower()
             password = (data.get('password') or '')
@@ -798,10 +3166,12 @@ class Handler(BaseHTTPRequestHandler):
             marketing_consent = bool(data.get('marketing_consent', False))
             if not email or not password:
                 return json_response(self, { 'ok': False, 'error': 'email_and_password_required' }, 400)
-            users = read_users()
-            if any(u for u in users if u.get('email') == email):
+            if USERS_STORE.find('email', email):
                 return json_response(self, { 'ok': False, 'error': 'email_exists' }, 409)
-            pwd = hash_password(password)
+            try:
+                pwd = run_hashing(hash_password, password)
+            except HashingBusy:
+                return busy_response(self)
             user = {
                 'id': f'user_{int(__import__("time").time()*1000)}',
                 'email': email,
@@ -810,112 +3180,100 @@ class Handler(BaseHTTPRequestHandler):
                 'marketing_consent': marketing_consent,
                 'password_salt': pwd['salt'],
                 'password_hash': pwd['hash'],
+                'password_version': pwd['version'],
                 'addresses': [],
                 'created_at': int(__import__('time').time()*1000)
             }
-            users.append(user)
-            write_users(users)
+            def add_user():
+                # Re-check under the writer so concurrent signups can't both win
+                if USERS_STORE.find('email', email):
+                    return None
+                return USERS_STORE.append(user)
+            if not WRITER.submit(add_user):
+                return json_response(self, { 'ok': False, 'error': 'email_exists' }, 409)
             sess = create_session(user['id'])
-            # Set cookie for convenience (optional; also return token)
-            self.send_response(200)
-            set_cors(self)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Set-Cookie', f"reweave_session={sess['token']}; Path=/; HttpOnly; SameSite=Lax")
-            self.end_headers()
-            safe_user = { k: user.get(k) for k in ['id','email','name','phone','marketing_consent'] }
-            self.wfile.write(json.dumps({ 'ok': True, 'token': sess['token'], 'user': safe_user }).encode('utf-8'))
-            return
+            # Sets cookie for convenience (optional; also returns token)
+            return session_response(self, sess, user)
 
         if parsed.path == '/api/auth/login':
             email = (data.get('email') or '').strip().lower()
             password = (data.get('password') or '')
-            users = read_users()
-            user = next((u for u in users if u.get('email') == email), None)
-            if not user or not verify_password(password, user.get('password_salt',''), user.get('password_hash','')):
+            user = USERS_STORE.find('email', email)
+            if not user:
+                return json_response(self, { 'ok': False, 'error': 'invalid_credentials' }, 401)
+            version = user.get('password_version', 1)
+            try:
+                ok = run_hashing(verify_password, password, user.get('password_salt',''), user.get('password_hash',''), version)
+            except HashingBusy:
+                return busy_response(self)
+            if not ok:
                 return json_response(self, { 'ok': False, 'error': 'invalid_credentials' }, 401)
+            if version != CURRENT_HASH_VERSION:
+                # Upgrade to the current cost; best effort, never fails the login
+                try:
+                    pwd = run_hashing(hash_password, password)
+                    def upgrade_hash(u):
+                        if u.get('password_hash') == user.get('password_hash'):
+                            u['password_salt'] = pwd['salt']
+                            u['password_hash'] = pwd['hash']
+                            u['password_version'] = pwd['version']
+                    update_record(USERS_STORE, user['id'], upgrade_hash)
+                except HashingBusy:
+                    pass
             sess = create_session(user['id'])
-            self.send_response(200)
-            set_cors(self)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Set-Cookie', f"reweave_session={sess['token']}; Path=/; HttpOnly; SameSite=Lax")
-            self.end_headers()
-            safe_user = { k: user.get(k) for k in ['id','email','name','phone','marketing_consent'] }
-            self.wfile.write(json.dumps({ 'ok': True, 'token': sess['token'], 'user': safe_user }).encode('utf-8'))
-            return
+            return session_response(self, sess, user)
 
         if parsed.path == '/api/auth/request-otp':
             email = (data.get('email') or '').strip().lower()
-            users = read_users()
-            user = next((u for u in users if u.get('email') == email), None)
+            user = USERS_STORE.find('email', email)
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'user_not_found' }, 404)
             code = f"{secrets.randbelow(1000000):06d}"
-            otps = read_otps()
             now_ms = int(__import__('time').time()*1000)
             expiry = now_ms + 5*60*1000
-            # Remove old OTPs for this email
-            otps = [o for o in otps if not (o.get('type') == 'otp' and o.get('email') == email)]
-            otps.append({ 'type': 'otp', 'email': email, 'code': code, 'expires': expiry })
-            write_otps(otps)
+            # Replaces old OTPs for this email
+            issue_otp({ 'type': 'otp', 'email': email, 'code': code, 'expires': expiry })
             # In production, send via email/SMS. For dev, return code.
             return json_response(self, { 'ok': True, 'sent': True, 'dev_otp': code })
 
         if parsed.path == '/api/auth/login-otp':
             email = (data.get('email') or '').strip().lower()
             code = (data.get('code') or '').strip()
-            otps = read_otps()
             now_ms = int(__import__('time').time()*1000)
-            match = next((o for o in otps if o.get('type') == 'otp' and o.get('email') == email and o.get('code') == code and o.get('expires',0) > now_ms), None)
+            # Redeem and clean up the OTP atomically
+            match = consume_otp(lambda o: o.get('type') == 'otp' and o.get('email') == email and o.get('code') == code and o.get('expires',0) > now_ms)
             if not match:
                 return json_response(self, { 'ok': False, 'error': 'invalid_or_expired_otp' }, 401)
-            # Clean up OTP
-            otps = [o for o in otps if not (o.get('type') == 'otp' and o.get('email') == email)]
-            write_otps(otps)
-            users = read_users()
-            user = next((u for u in users if u.get('email') == email), None)
+            user = USERS_STORE.find('email', email)
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'user_not_found' }, 404)
             sess = create_session(user['id'])
-            self.send_response(200)
-            set_cors(self)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Set-Cookie', f"reweave_session={sess['token']}; Path=/; HttpOnly; SameSite=Lax")
-            self.end_headers()
-            safe_user = { k: user.get(k) for k in ['id','email','name','phone','marketing_consent'] }
-            self.wfile.write(json.dumps({ 'ok': True, 'token': sess['token'], 'user': safe_user }).encode('utf-8'))
-            return
+            return session_response(self, sess, user)
 
         if parsed.path == '/api/auth/request-magic-link':
             email = (data.get('email') or '').strip().lower()
-            users = read_users()
-            user = next((u for u in users if u.get('email') == email), None)
+            user = USERS_STORE.find('email', email)
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'user_not_found' }, 404)
             token = secrets.token_urlsafe(32)
-            otps = read_otps()
             now_ms = int(__import__('time').time()*1000)
             expiry = now_ms + 15*60*1000
-            otps = [o for o in otps if not (o.get('type') == 'magic' and o.get('email') == email)]
-            otps.append({ 'type': 'magic', 'email': email, 'token': token, 'expires': expiry })
-            write_otps(otps)
+            issue_otp({ 'type': 'magic', 'email': email, 'token': token, 'expires': expiry })
             link = f"http://localhost:{PORT}/api/auth/magic-login?token={token}"
             # In production, email this link. For dev, return it.
             return json_response(self, { 'ok': True, 'link': link })
 
         if parsed.path == '/api/auth/request-reset':
             email = (data.get('email') or '').strip().lower()
-            users = read_users()
-            user = next((u for u in users if u.get('email') == email), None)
+            user = USERS_STORE.find('email', email)
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'user_not_found' }, 404)
             token = secrets.token_urlsafe(32)
             expiry = int(__import__('time').time()*1000) + 15*60*1000
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    u['reset_token'] = token
-                    u['reset_expires'] = expiry
-                    break
-            write_users(users)
+            def set_reset(u):
+                u['reset_token'] = token
+                u['reset_expires'] = expiry
+            update_record(USERS_STORE, user['id'], set_reset)
             return json_response(self, { 'ok': True, 'sent': True, 'dev_token': token })
 
         if parsed.path == '/api/auth/reset':
@@ -923,36 +3281,32 @@ class Handler(BaseHTTPRequestHandler):
             new_password = (data.get('password') or '')
             if not token or not new_password:
                 return json_response(self, { 'ok': False, 'error': 'token_and_password_required' }, 400)
-            users = read_users()
             now_ms = int(__import__('time').time()*1000)
-            user = next((u for u in users if u.get('reset_token') == token and u.get('reset_expires',0) > now_ms), None)
-            if not user:
+            user = USERS_STORE.find('reset_token', token)
+            if not user or user.get('reset_expires',0) <= now_ms:
                 return json_response(self, { 'ok': False, 'error': 'invalid_or_expired_token' }, 400)
-            pwd = hash_password(new_password)
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    u['password_salt'] = pwd['salt']
-                    u['password_hash'] = pwd['hash']
-                    u.pop('reset_token', None)
-                    u.pop('reset_expires', None)
-                    break
-            write_users(users)
+            try:
+                pwd = run_hashing(hash_password, new_password)
+            except HashingBusy:
+                return busy_response(self)
+            def apply_reset(u):
+                # The token may have been used meanwhile; only the first reset applies
+                if u.get('reset_token') != token:
+                    return
+                u['password_salt'] = pwd['salt']
+                u['password_hash'] = pwd['hash']
+                u['password_version'] = pwd['version']
+                u.pop('reset_token', None)
+                u.pop('reset_expires', None)
+            update_record(USERS_STORE, user['id'], apply_reset)
             return json_response(self, { 'ok': True })
 
         if parsed.path == '/api/auth/logout':
             token = get_token_from_headers(self)
             if token:
-                sessions = read_sessions()
-                sessions = [s for s in sessions if s.get('token') != token]
-                write_sessions(sessions)
+                WRITER.submit(SESSIONS_STORE.delete, token)
             # Clear cookie
-            self.send_response(200)
-            set_cors(self)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Set-Cookie', "reweave_session=; Path=/; Max-Age=0; HttpOnly; SameSite=Lax")
-            self.end_headers()
-            self.wfile.write(json.dumps({ 'ok': True }).encode('utf-8'))
-            return
+            return json_response(self, { 'ok': True }, 200, { 'Set-Cookie': "reweave_session=; Path=/; Max-Age=0; HttpOnly; SameSite=Lax" })
 
         if parsed.path == '/api/addresses':
             user = get_user_from_request(self)
@@ -968,17 +3322,14 @@ class Handler(BaseHTTPRequestHandler):
                 'country': (data.get('country') or '').strip(),
                 'is_default': bool(data.get('is_default', False))
             }
-            users = read_users()
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    addrs = u.get('addresses', [])
-                    if addr['is_default']:
-                        for a in addrs:
-                            a['is_default'] = False
-                    addrs.append(addr)
-                    u['addresses'] = addrs
-                    break
-            write_users(users)
+            def add_address(u):
+                addrs = u.get('addresses', [])
+                if addr['is_default']:
+                    for a in addrs:
+                        a['is_default'] = False
+                addrs.append(addr)
+                u['addresses'] = addrs
+            update_record(USERS_STORE, user['id'], add_address)
             return json_response(self, { 'ok': True, 'address': addr })
 
         if parsed.path == '/api/wishlist':
@@ -988,15 +3339,12 @@ class Handler(BaseHTTPRequestHandler):
             product_id = (data.get('productId') or '').strip()
             if not product_id:
                 return json_response(self, { 'ok': False, 'error': 'productId_required' }, 400)
-            users = read_users()
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    wl = u.get('wishlist', [])
-                    if product_id not in wl:
-                        wl.append(product_id)
-                    u['wishlist'] = wl
-                    break
-            write_users(users)
+            def add_to_wishlist(u):
+                wl = u.get('wishlist', [])
+                if product_id not in wl:
+                    wl.append(product_id)
+                u['wishlist'] = wl
+            u = update_record(USERS_STORE, user['id'], add_to_wishlist) or {}
             return json_response(self, { 'ok': True, 'items': u.get('wishlist', []) })
 
         if parsed.path.startswith('/api/wishlist/'):
@@ -1004,28 +3352,21 @@ class Handler(BaseHTTPRequestHandler):
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'unauthorized' }, 401)
             product_id = parsed.path.split('/api/wishlist/', 1)[1]
-            users = read_users()
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    wl = [pid for pid in u.get('wishlist', []) if pid != product_id]
-                    u['wishlist'] = wl
-                    break
-            write_users(users)
+            def remove_from_wishlist(u):
+                u['wishlist'] = [pid for pid in u.get('wishlist', []) if pid != product_id]
+            update_record(USERS_STORE, user['id'], remove_from_wishlist)
             return json_response(self, { 'ok': True })
 
         if parsed.path == '/api/me/preferences':
             user = get_user_from_request(self)
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'unauthorized' }, 401)
-            users = read_users()
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    u['marketing_consent'] = bool(data.get('marketing_consent', u.get('marketing_consent', False)))
-                    prefs = data.get('communication_prefs', {})
-                    if isinstance(prefs, dict):
-                        u['communication_prefs'] = prefs
-                    break
-            write_users(users)
+            def set_preferences(u):
+                u['marketing_consent'] = bool(data.get('marketing_consent', u.get('marketing_consent', False)))
+                prefs = data.get('communication_prefs', {})
+                if isinstance(prefs, dict):
+                    u['communication_prefs'] = prefs
+            update_record(USERS_STORE, user['id'], set_preferences)
             return json_response(self, { 'ok': True })
 
         if parsed.path == '/api/payment-methods':
@@ -1040,14 +3381,11 @@ class Handler(BaseHTTPRequestHandler):
                 'exp_year': int(data.get('exp_year', 2030)),
                 'created_at': int(__import__('time').time()*1000)
             }
-            users = read_users()
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    methods = u.get('payment_methods', [])
-                    methods.append(pm)
-                    u['payment_methods'] = methods
-                    break
-            write_users(users)
+            def add_payment_method(u):
+                methods = u.get('payment_methods', [])
+                methods.append(pm)
+                u['payment_methods'] = methods
+            update_record(USERS_STORE, user['id'], add_payment_method)
             return json_response(self, { 'ok': True, 'payment_method': pm })
 
         if parsed.path.startswith('/api/payment-methods/'):
@@ -1055,22 +3393,94 @@ class Handler(BaseHTTPRequestHandler):
             if not user:
                 return json_response(self, { 'ok': False, 'error': 'unauthorized' }, 401)
             pm_id = parsed.path.split('/api/payment-methods/', 1)[1]
-            users = read_users()
-            removed = False
-            for u in users:
-                if u.get('id') == user.get('id'):
-                    methods = [m for m in u.get('payment_methods', []) if m.get('id') != pm_id]
-                    removed = len(methods) != len(u.get('payment_methods', []))
-                    u['payment_methods'] = methods
-                    break
-            write_users(users)
-            if not removed:
+            removed = []
+            def remove_payment_method(u):
+                methods = [m for m in u.get('payment_methods', []) if m.get('id') != pm_id]
+                removed.append(len(methods) != len(u.get('payment_methods', [])))
+                u['payment_methods'] = methods
+            update_record(USERS_STORE, user['id'], remove_payment_method)
+            if not any(removed):
                 return json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
             return json_response(self, { 'ok': True })
 
         json_response(self, { 'ok': False, 'error': 'not_found' }, 404)
 
-def run():
+# Connections are served by a bounded thread pool. Once every worker is busy
+# and REWEAVE_MAX_PENDING connections are queued, the accept loop stops taking
+# new ones and they wait in the kernel backlog instead of piling up in memory.
+# PBKDF2 and SQLite release the GIL, so the slow auth paths use every core.
+class PooledHTTPServer(HTTPServer):
+    request_queue_size = 128
+
+    def __init__(self, address, handler, workers, max_pending=None):
+        super().__init__(address, handler)
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reweave-http')
+        self.slots = threading.BoundedSemaphore(workers + (max_pending if max_pending is not None else MAX_PENDING))
+        self.inflight = 0
+        self._inflight_lock = threading.Lock()
+
+    def saturated(self):
+        # More open connections than workers means someone is queued
+        return self.inflight > self.workers
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        with self._inflight_lock:
+            self.inflight += 1
+        try:
+            self.pool.submit(self.process_request_worker, request, client_address)
+        except Exception:
+            self.release_slot()
+            self.shutdown_request(request)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.release_slot()
+
+    def release_slot(self):
+        with self._inflight_lock:
+            self.inflight -= 1
+        self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+# The single-threaded server can't park keep-alive connections, so it closes
+# after every response like the original HTTP/1.0 handler did
+class SingleThreadHandler(Handler):
+    protocol_version = 'HTTP/1.0'
+
+def make_server(host, port, workers):
+    # workers=0 keeps the original single-threaded server
+    if workers <= 0:
+        return HTTPServer((host, port), SingleThreadHandler)
+    limit_hashing(workers)
+    return PooledHTTPServer((host, port), Handler, workers)
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description='Reweave backend')
+    parser.add_argument('--host', default=os.environ.get('HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='worker threads (0 = single-threaded); env REWEAVE_WORKERS')
+    parser.add_argument('--backfill-rollups', nargs='?', const='', metavar='ORDERS_JSON',
+                        help='rebuild the revenue rollups from the order history (or the given orders JSON file) and exit')
+    args = parser.parse_args(argv)
+    if args.backfill_rollups is not None:
+        init_db()
+        orders = ORDERS_STORE.all()
+        if args.backfill_rollups:
+            with open(args.backfill_rollups, 'r') as f:
+                orders = json.load(f)
+        paid = WRITER.submit(lambda: backfill_rollups(WRITER.db().cursor(), orders))
+        print(f'[rollups] rebuilt from {len(orders)} orders ({paid} paid)')
+        return
     # Initialize DB and seed from products.json when empty
     try:
         init_db()
@@ -1078,9 +3488,16 @@ def run():
             seed_products_from_json_to_db()
     except Exception as e:
         print('[db-init] warning:', e)
-    server = HTTPServer(('localhost', PORT), Handler)
-    print(f"[reweave-backend-py] listening on http://localhost:{PORT}")
-    server.serve_forever()
+    start_background_tasks()
+    server = make_server(args.host, args.port, args.workers)
+    mode = f'{args.workers} workers' if args.workers > 0 else 'single-threaded'
+    print(f"[reweave-backend-py] listening on http://{args.host}:{args.port} ({mode})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    EVENT_BUFFER.flush()
 
 if __name__ == '__main__':
     run()
\ No newline at end of file
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Benchmark for the suggestion scorer in api/suggest_server.py: per-request
+# latency of rank_products on synthetic catalogs, NumPy vs pure Python
+# (NumPy rows only when it is installed). Run from the repository root:
+#   python archive/backend-files/backend/suggest_bench.py --bench 10000,100000
+import argparse
+import importlib
+import os
+import random
+import sys
+import time
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'api')
+
+def load_suggest():
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+    return importlib.import_module('suggest_server')
+
+def synthetic_catalog(n, seed=7):
+    rng = random.Random(seed)
+    colors = [f'color-{i}' for i in range(48)]
+    categories = ['Tote', 'Sling', 'Pouch', 'Batik', 'Songket', 'Canvas']
+    products = []
+    for i in range(n):
+        variants = [{'sku': f'p{i}-{j}', 'price': rng.randint(40, 900), 'options': {'Color': rng.choice(colors)}}
+                    for j in range(rng.randint(1, 4))]
+        products.append({'id': f'p{i}', 'name': f'Product {i}', 'price': min(v['price'] for v in variants),
+                         'categories': [rng.choice(['Bags', 'Accessories'])] + rng.sample(categories, 2),
+                         'variants': variants})
+    return products, colors
+
+def bench(suggest, sizes, rounds=200):
+    # Per-request latency of the deterministic scorer, vectorized vs pure Python
+    print(f"numpy {'available' if suggest.np is not None else 'not installed: pure-Python scorer only'}")
+    print(f"{'products':>9} {'mode':>8} {'engine':>7} {'build ms':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for n in sizes:
+        products, colors = synthetic_catalog(n)
+        t0 = time.perf_counter()
+        catalog = suggest.Catalog(products, version=f'bench-{n}')
+        features_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        catalog.scoring()
+        index_ms = (time.perf_counter() - t0) * 1000
+        rng = random.Random(n)
+        requests = {
+            'mirror': [suggest.normalize_prefs('mirror', {'colors': [{'color': c, 'weight': rng.choice([0.5, 1, 2])} for c in rng.sample(colors, 3)]})
+                       for _ in range(rounds)],
+            'copilot': [suggest.normalize_prefs('copilot', {'occasion': rng.choice(['work', 'casual', 'evening']), 'budget': rng.randint(100, 600),
+                                                            'palette': ', '.join(rng.sample(colors, 2))})
+                        for _ in range(rounds)],
+        }
+        engines = [('python', False, features_ms)] + ([('numpy', True, features_ms + index_ms)] if suggest.np is not None else [])
+        for mode, prefs_list in requests.items():
+            picks = {}
+            for engine, vectorized, build_ms in engines:
+                times = []
+                picks[engine] = []
+                for prefs in prefs_list:
+                    t0 = time.perf_counter()
+                    picks[engine].append([f.id for f in suggest.rank_products(mode, prefs, catalog, vectorized=vectorized)])
+                    times.append(time.perf_counter() - t0)
+                times.sort()
+                print(f"{n:>9} {mode:>8} {engine:>7} {build_ms:>9.1f} {times[len(times) // 2] * 1000:>8.2f} {times[int(len(times) * 0.99)] * 1000:>8.2f}")
+            if len(picks) > 1 and picks['python'] != picks['numpy']:
+                print(f'{n:>9} {mode:>8} engines disagree')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reweave suggestion scorer benchmark')
+    parser.add_argument('--bench', default='10000,100000', metavar='SIZES',
+                        help='comma-separated synthetic catalog sizes')
+    args = parser.parse_args(argv)
+    bench(load_suggest(), [int(n) for n in args.bench.split(',')])
+
+if __name__ == '__main__':
+    main()
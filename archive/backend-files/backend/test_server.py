@@ -0,0 +1,239 @@
+# Regression tests for server.py. Run from archive/backend-files:
+#   python -m unittest discover -s backend -p 'test_*.py'
+# server.py resolves backend/data against the working directory at import
+# time, so the module is imported once against a throwaway copy of it.
+import importlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def setUpModule():
+    global server, workdir, cwd
+    workdir = tempfile.mkdtemp(prefix='reweave-test-')
+    shutil.copytree(os.path.join(HERE, 'data'), os.path.join(workdir, 'backend', 'data'),
+                    ignore=shutil.ignore_patterns('*.jsonl', '*.tmp', 'events'))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    server = importlib.import_module('server')
+    server.init_db()
+
+def tearDownModule():
+    os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+class FakeHandler:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+class WriterTest(unittest.TestCase):
+    def test_survives_a_transaction_sqlite_rolled_back(self):
+        # What SQLite does on disk full / I/O errors: the whole transaction
+        # is gone before the job's exception reaches the writer
+        def job():
+            db = server.WRITER.db()
+            db.execute('CREATE TABLE IF NOT EXISTS writer_test (x INTEGER)')
+            db.execute('INSERT INTO writer_test VALUES (1)')
+            db.execute('ROLLBACK')
+            raise sqlite3.OperationalError('disk I/O error')
+        with self.assertRaises(sqlite3.OperationalError):
+            server.WRITER.submit(job)
+        self.assertEqual(server.WRITER.submit(lambda: 42), 42)
+        self.assertEqual(server.WRITER.submit(lambda: server.WRITER.db().execute('SELECT 1').fetchone()[0]), 1)
+
+class FpxWebhookTest(unittest.TestCase):
+    def deliver(self, data, headers=None):
+        # What POST /api/fpx/webhook does, then one inbox pass
+        body = server.json.dumps(data)
+        key = server.fpx_idempotency_key(FakeHandler(headers), data, body)
+        new = server.WRITER.submit(server.record_webhook, key, data)
+        server.WRITER.submit(server.process_inbox_batch)
+        return new
+
+    def place_order(self):
+        lines, total = server.price_cart([{ 'sku': 'PT-STD-001', 'quantity': 1 }])
+        now = int(time.time() * 1000)
+        order = { 'id': server.ORDER_IDS.next(), 'items': lines, 'total': total / 100, 'currency': 'MYR',
+                  'status': 'pending_payment', 'created_at': now, 'updated_at': now }
+        return server.WRITER.submit(server.place_order, order)['id']
+
+    def status(self, order_id):
+        return server.ORDERS_STORE.get(order_id)['status']
+
+    def test_pending_then_success_for_one_transaction(self):
+        order_id = self.place_order()
+        self.assertTrue(self.deliver({ 'orderId': order_id, 'status': 'pending', 'transactionId': 'TX-pending' }))
+        self.assertEqual(self.status(order_id), 'payment_pending')
+        self.assertTrue(self.deliver({ 'orderId': order_id, 'status': 'success', 'transactionId': 'TX-pending' }))
+        self.assertEqual(self.status(order_id), 'paid')
+
+    def test_retried_callback_is_a_duplicate(self):
+        order_id = self.place_order()
+        data = { 'orderId': order_id, 'status': 'success', 'transactionId': 'TX-retry' }
+        self.assertTrue(self.deliver(data))
+        self.assertFalse(self.deliver(data))
+        self.assertFalse(self.deliver(dict(data, status='SUCCESS')))
+
+    def test_paid_amount_must_match_order_total(self):
+        order_id = self.place_order()
+        total = server.ORDERS_STORE.get(order_id)['total']
+        self.assertTrue(self.deliver({ 'orderId': order_id, 'status': 'success', 'transactionId': 'TX-short', 'amount': '1.00' }))
+        self.assertEqual(self.status(order_id), 'pending_payment')
+        self.assertTrue(self.deliver({ 'orderId': order_id, 'status': 'success', 'transactionId': 'TX-full', 'amount': f'{total:.2f}' }))
+        self.assertEqual(self.status(order_id), 'paid')
+
+    def test_idempotency_key_header_names_the_delivery(self):
+        order_id = self.place_order()
+        headers = { 'Idempotency-Key': 'delivery-1' }
+        self.assertTrue(self.deliver({ 'orderId': order_id, 'status': 'pending' }, headers))
+        self.assertFalse(self.deliver({ 'orderId': order_id, 'status': 'success' }, headers))
+        self.assertEqual(self.status(order_id), 'payment_pending')
+
+class PriceCartTest(unittest.TestCase):
+    def test_non_string_identifiers_are_rejected(self):
+        for item in ({ 'sku': ['PT-STD-001'] }, { 'id': { 'a': 1 } }, { 'productId': [1], 'variant': 'Songket' }, { 'sku': True }):
+            with self.assertRaises(server.CartError) as ctx:
+                server.price_cart([item])
+            self.assertEqual(ctx.exception.code, 'invalid_item')
+
+    def test_prices_from_the_variants_table(self):
+        lines, total = server.price_cart([{ 'id': 'luxe-mini', 'variant': 'Batik/Cotton', 'quantity': 2, 'price': 1 }])
+        self.assertEqual(lines[0]['sku'], 'LM-BTK-001')
+        self.assertEqual(total, 2 * 11900)
+
+class ProductDetailTest(unittest.TestCase):
+    def test_detail_matches_catalog_record(self):
+        listed = next(p for p in server.get_products_from_db() if p['id'] == 'luxe-mini')
+        detail = server.get_product_from_db('luxe-mini')
+        self.assertEqual(detail, listed)
+        self.assertIn('tags', detail)
+        self.assertEqual({ v['sku']: v.get('option') for v in detail['variants'] },
+                         { 'LM-SNG-001': 'Songket', 'LM-BTK-001': 'Batik/Cotton' })
+
+    def test_unknown_product(self):
+        self.assertIsNone(server.get_product_from_db('no-such-product'))
+
+class HashAdmissionTest(unittest.TestCase):
+    def test_logins_leave_http_workers_free(self):
+        for workers in (2, 4, 8, 32, 64):
+            self.assertLess(server.hash_admission_limit(workers), workers)
+        self.assertEqual(server.hash_admission_limit(1), 1)
+
+class EventBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buf = server.EventBuffer(8, 1000)
+        self.events = [server.make_event('buffer_test', { 'i': i }, 'test') for i in range(3)]
+        self.assertTrue(self.buf.offer(self.events))
+        self.before = server.EVENTS_STORE.count()
+
+    def stored(self):
+        ids = { e['id'] for e in self.events }
+        return [e['id'] for e in server.EVENTS_STORE.scan(types={ 'buffer_test' }) if e['id'] in ids]
+
+    def test_failed_append_keeps_the_rest(self):
+        store = server.EVENTS_STORE
+        append = store.append
+        def failing(record):
+            if record['id'] == self.events[1]['id']:
+                raise OSError('disk full')
+            return append(record)
+        store.append = failing
+        try:
+            with self.assertRaises(OSError):
+                self.buf.flush()
+        finally:
+            del store.append
+        self.assertEqual(self.buf.stats()['buffered'], 2)
+        self.assertEqual(self.buf.flush(), 2)
+        self.assertEqual(self.buf.stats()['buffered'], 0)
+        self.assertEqual(sorted(self.stored()), sorted(e['id'] for e in self.events))
+        self.assertEqual(store.count(), self.before + 3)
+
+    def test_failed_commit_does_not_store_twice(self):
+        # The archive took the batch, then the group commit failed
+        store = server.EVENTS_STORE
+        def failing():
+            del store.sync
+            raise OSError('fsync failed')
+        store.sync = failing
+        with self.assertRaises(OSError):
+            self.buf.flush()
+        self.assertEqual(self.buf.stats()['buffered'], 0)
+        self.assertEqual(self.buf.flush(), 0)
+        self.assertEqual(sorted(self.stored()), sorted(e['id'] for e in self.events))
+        self.assertEqual(store.count(), self.before + 3)
+
+class EventArchiveTest(unittest.TestCase):
+    DAY = 86400 * 1000
+    START = 1760000000000
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='reweave-archive-'), 'events')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.path), True)
+        self.seq = 0
+
+    def event(self, day):
+        self.seq += 1
+        return { 'id': f'evt_{self.seq:06d}', 'type': 'page_view', 'payload': {}, 'ts': self.START + day * self.DAY + self.seq, 'ua': '' }
+
+    def reopen(self, archive):
+        archive.sync()
+        return server.EventArchive(self.path)
+
+    def test_late_events_survive_a_restart_before_the_next_seal(self):
+        archive = server.EventArchive(self.path)
+        for day in range(3):
+            for _ in range(5):
+                archive.append(self.event(day))
+        today = server.event_day(self.START + 3 * self.DAY)
+        self.assertEqual(archive.seal(today), 3)
+        archive.append(self.event(0))
+        archive.append(self.event(1))
+        self.assertEqual(archive.count(), 17)
+        archive = self.reopen(archive)
+        self.assertEqual(archive.count(), 17)
+        self.assertEqual(len(list(archive.scan())), 17)
+        archive.seal(today)
+        archive = self.reopen(archive)
+        self.assertEqual(archive.count(), 17)
+        self.assertEqual(len(list(archive.scan())), 17)
+
+    def test_seal_cut_short_before_the_manifest(self):
+        # The .evc was written, the crash came before the manifest and the
+        # segment's removal: its rows must not be counted twice
+        archive = server.EventArchive(self.path)
+        for _ in range(5):
+            archive.append(self.event(0))
+        archive.sync()
+        manifest = os.path.join(self.path, 'manifest.json')
+        with open(manifest) as f:
+            before = f.read()
+        archive._write_partition(archive._file(server.event_day(self.START), 'evc'), archive._hot[server.event_day(self.START)])
+        with open(manifest, 'w') as f:
+            f.write(before)
+        archive = server.EventArchive(self.path)
+        self.assertEqual(archive.count(), 5)
+        self.assertEqual(len(list(archive.scan())), 5)
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        for key in (['lead_1'], [1700000000000, 'evt_1']):
+            self.assertEqual(server.decode_cursor(server.encode_cursor(key)), tuple(key))
+
+    def test_malformed_cursors_are_rejected(self):
+        for key in ([[1]], [{ 'a': 1 }], [], [1.5], [True], ['a', 'b', 'c'], { 'id': 1 }, 'id'):
+            token = server.base64.urlsafe_b64encode(server.json.dumps(key).encode('utf-8')).decode('ascii')
+            with self.assertRaises(ValueError):
+                server.decode_cursor(token)
+        with self.assertRaises(ValueError):
+            server.decode_cursor('not-a-cursor')
+
+if __name__ == '__main__':
+    unittest.main()